@@ -0,0 +1,455 @@
+import argparse
+import io
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+import process
+
+# Library sizes and stage inputs per scale. Every run with the same scale and seed sees the same data.
+SCALES = {
+    'small': {'albums': 4, 'files_per_album': 50, 'gallery_items': [1000, 10000], 'parity_mb': [64],
+              'inventory_files': [100000]},
+    'medium': {'albums': 20, 'files_per_album': 200, 'gallery_items': [10000, 100000], 'parity_mb': [256],
+               'inventory_files': [1000000]},
+    'large': {'albums': 50, 'files_per_album': 1000, 'gallery_items': [100000, 1000000], 'parity_mb': [1024],
+              'inventory_files': [1000000, 5000000]},
+}
+THUMBNAIL_SAMPLE = 20  # files per kind decoded by the thumbnail benchmark
+
+
+def tool_available(name):
+    return shutil.which(name) is not None or shutil.which(f"{name}.exe") is not None
+
+
+# Synthetic media library
+
+def jpeg_with_date(template, taken):
+    exif = Image.Exif()
+    exif[0x0132] = taken.strftime("%Y:%m:%d %H:%M:%S")  # DateTime
+    exif.get_ifd(0x8769)[0x9003] = taken.strftime("%Y:%m:%d %H:%M:%S")  # DateTimeOriginal
+    buffer = io.BytesIO()
+    template.save(buffer, 'JPEG', quality=85, exif=exif)
+    return buffer.getvalue()
+
+
+def takeout_sidecar(name, taken):
+    timestamp = str(int(taken.timestamp()))
+    formatted = taken.strftime("%b %d, %Y, %I:%M:%S %p UTC")
+    return {
+        'title': name,
+        'description': '',
+        'creationTime': {'timestamp': timestamp, 'formatted': formatted},
+        'photoTakenTime': {'timestamp': timestamp, 'formatted': formatted},
+        'geoData': {'latitude': 0.0, 'longitude': 0.0, 'altitude': 0.0},
+    }
+
+
+def write_video(path, taken, seconds=1):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=320x240:rate=10',
+                    '-c:v', 'mpeg4', '-metadata', f"creation_time={taken.isoformat()}", path], check=True)
+
+
+def generate_library(root, albums, files_per_album, seed=0, median_kb=300, video_share=0.05, raw_share=0.05,
+                     sidecar_share=0.5):
+    """Write a synthetic library of albums under root: JPEGs with EXIF dates and log-normally distributed
+    sizes, Takeout-style JSON sidecars, short videos (when ffmpeg is installed) and RAW-like files that no
+    decoder can read. Returns counts per kind."""
+    rng = random.Random(seed)
+    with_video = tool_available('ffmpeg')
+    templates = []
+    for i in range(4):
+        noise = Image.effect_noise((640, 480), 40 + 20 * i)
+        templates.append(Image.merge('RGB', [noise, noise.transpose(Image.FLIP_TOP_BOTTOM), noise.transpose(Image.FLIP_LEFT_RIGHT)]))
+    first_date = datetime(2008, 1, 1)
+    counts = {'jpeg': 0, 'video': 0, 'raw': 0, 'sidecar': 0}
+
+    for a in range(albums):
+        album_dir = os.path.join(root, f"Album {a:03d}")
+        os.makedirs(album_dir, exist_ok=True)
+        album_start = first_date + timedelta(days=rng.randrange(15 * 365))
+        for i in range(files_per_album):
+            taken = album_start + timedelta(seconds=rng.randrange(14 * 86400))
+            size = int(math.exp(rng.gauss(math.log(median_kb * 1024), 0.8)))
+            kind = rng.random()
+            if kind < video_share and with_video:
+                name = f"VID_{a:03d}_{i:05d}.mp4"
+                write_video(os.path.join(album_dir, name), taken)
+                counts['video'] += 1
+            elif kind < video_share + raw_share:
+                name = f"RAW_{a:03d}_{i:05d}.orf"
+                with open(os.path.join(album_dir, name), 'wb') as f:
+                    f.write(b'IIRO\x08\x00\x00\x00' + rng.randbytes(size * 3))
+                counts['raw'] += 1
+            else:
+                name = f"IMG_{a:03d}_{i:05d}.jpg"
+                data = jpeg_with_date(templates[i % len(templates)], taken)
+                with open(os.path.join(album_dir, name), 'wb') as f:
+                    # Bytes after the end-of-image marker are ignored by decoders, so they only set the size
+                    f.write(data + rng.randbytes(max(0, size - len(data))))
+                counts['jpeg'] += 1
+            os.utime(os.path.join(album_dir, name), (taken.timestamp(), taken.timestamp()))
+            if rng.random() < sidecar_share:
+                with open(os.path.join(album_dir, f"{name}.json"), 'w', encoding='utf-8') as f:
+                    json.dump(takeout_sidecar(name, taken), f, indent=2)
+                counts['sidecar'] += 1
+    return counts
+
+
+def library_files(root):
+    return sorted(os.path.join(dirpath, f) for dirpath, _, files in os.walk(root) for f in files)
+
+
+def synthetic_gallery_albums(item_count, items_per_album=300):
+    albums = {}
+    start = datetime(2010, 1, 1)
+    for i in range(item_count):
+        album_name = f"Album {i // items_per_album:05d}"
+        albums.setdefault(album_name, []).append((f"{album_name}/IMG_{i:07d}.jpg", "image", start + timedelta(hours=i),
+                                                  (4032, 3024, None, "Canon EOS R6")))
+    return albums
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+# Stage benchmarks. Each returns {case: {'seconds': ..., 'items': ..., 'unit': ..., 'rate': ...}} and times
+# the best of `repeat` runs, so a busy machine shows up as noise less often.
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(seconds, items, unit, **extra):
+    return dict({'seconds': round(seconds, 6), 'items': items, 'unit': unit,
+                 'rate': round(items / seconds, 2) if seconds else None}, **extra)
+
+
+def benchmark_scan(library, repeat):
+    scanned = []
+    seconds = best_of(repeat, lambda: scanned.__setitem__(slice(None), process.scan_inventory(library)))
+    return {'scan': result(seconds, len(scanned[0]), 'files')}
+
+
+def benchmark_dates(library, repeat):
+    files = library_files(library)
+    sidecars = [f for f in files if f.endswith('.json')]
+    results = {'dates.sidecar': result(best_of(repeat, lambda: [process.get_date_taken(f) for f in sidecars]),
+                                       len(sidecars), 'files')}
+    if tool_available('exiftool'):
+        media = [f for f in files if not f.endswith('.json')][:200]
+        results['dates.exiftool'] = result(best_of(repeat, lambda: [process.get_date_taken(f) for f in media]),
+                                           len(media), 'files')
+    else:
+        print("exiftool not found, skipping dates.exiftool")
+    return results
+
+
+def library_inventory(library):
+    # Dated from the file times, so packing can be measured without exiftool
+    inventory, _ = process.scan_inventory(library)
+    inventory.date[:] = inventory.mtime
+    return inventory
+
+
+def albums_split(inventory, discs):
+    # Albums whose files ended up on more than one disc
+    album_discs = {}
+    for disc_index, disc in enumerate(discs):
+        for row in disc:
+            album_discs.setdefault(inventory.album[row], set()).add(disc_index)
+    return sum(len(disc_indexes) > 1 for disc_indexes in album_discs.values())
+
+
+def bench_segmented_packing(inventory, capacity, repeat, name):
+    # Segmentation runs once, as in a real run; the packer is timed on its result
+    start = time.perf_counter()
+    process.segment_inventory(inventory, capacity * process.SEGMENT_DISC_SHARE)
+    results = {f'segments{name}': result(time.perf_counter() - start, len(inventory), 'files',
+                                         segments=len(inventory.segments))}
+    discs = []
+    seconds = best_of(repeat, lambda: discs.__setitem__(slice(None), process.optimize_disc_packing(inventory, capacity)))
+    results[f'packing{name}'] = result(seconds, len(inventory), 'files', discs=len(discs),
+                                       albums_split=albums_split(inventory, discs))
+    return results
+
+
+def benchmark_packing(library, repeat):
+    inventory = library_inventory(library)
+    total = inventory.total_size(range(len(inventory)))
+    # Sized for several discs, so the packer has real choices to make
+    return bench_segmented_packing(inventory, total / 4.5, repeat, '')
+
+
+def synthetic_inventory(file_count, seed=0, files_per_album=1000):
+    """An inventory of file_count files with log-normal sizes, taken in bursts a few days apart, built
+    without touching the disk."""
+    rng = random.Random(seed)
+    inventory = process.FileInventory('/library')
+    start = datetime(2010, 1, 1).timestamp()
+    for i in range(file_count):
+        if i % files_per_album == 0:
+            album_id = inventory.add_album(f"Photos/{2010 + i // 500000}/Album {i // files_per_album:05d}")
+        if i % 300 == 0 or i % files_per_album == 0:
+            part = (i % files_per_album) // 300
+            name = inventory.albums[album_id]
+            inventory.add_segment(f"{name}_{part + 1}" if part else name, album_id)
+        inventory.add_file(f"IMG_{i:08d}.JPG", int(rng.lognormvariate(14.5, 0.8)), start + i * 60 + (i // 150) * 5 * 86400)
+    inventory.date[:] = inventory.mtime
+    return inventory
+
+
+def benchmark_inventory(file_counts, repeat):
+    # Memory is what limits multi-million-file libraries, so each case reports the inventory's footprint,
+    # what the per-file tuples it replaced took for the same files, and what a pool worker receives
+    results = {}
+    for file_count in file_counts:
+        tracemalloc.start()
+        start = time.perf_counter()
+        inventory = synthetic_inventory(file_count)
+        seconds = time.perf_counter() - start
+        inventory_mb = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+        tracemalloc.stop()
+        pickled_mb = len(pickle.dumps(inventory, protocol=pickle.HIGHEST_PROTOCOL)) / (1024 * 1024)
+
+        tracemalloc.start()
+        tuples = [(inventory.albums[inventory.album[row]], inventory.segments[inventory.segment[row]],
+                   inventory.name(row), inventory.size[row], inventory.mtime[row], inventory.date_taken(row))
+                  for row in range(file_count)]
+        tuples_mb = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+        tracemalloc.stop()
+        del tuples
+
+        results[f'inventory[{file_count}]'] = result(seconds, file_count, 'files', memory_mb=round(inventory_mb, 1),
+                                                     tuples_mb=round(tuples_mb, 1), pickled_mb=round(pickled_mb, 1))
+        results.update(bench_segmented_packing(inventory, inventory.total_size(range(file_count)) / 40, repeat, f'[{file_count}]'))
+    return results
+
+
+def benchmark_startup(repeat, workers=4):
+    # Each case runs in a fresh interpreter, since this one has already imported everything. Spawned pools
+    # (the default on Windows and macOS) re-import process.py in every worker, so its import cost is paid
+    # once per worker per stage
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code):
+        return best_of(repeat, lambda: subprocess.run([sys.executable, '-c', code], cwd=here, check=True))
+
+    interpreter = run('pass')
+    imports = run('import process')
+    loaded = subprocess.run([sys.executable, '-c', "import process, sys; print(' '.join(m for m in "
+                             "('PIL', 'rawpy', 'exiftool', 'tqdm', 'numpy') if m in sys.modules))"],
+                            cwd=here, check=True, capture_output=True, text=True).stdout.split()
+    pool = run("import multiprocessing, process\n"
+               "from concurrent.futures import ProcessPoolExecutor\n"
+               f"with ProcessPoolExecutor({workers}, mp_context=multiprocessing.get_context('spawn')) as executor:\n"
+               f"    list(executor.map(process.getCPUs, range({workers})))\n")
+    return {
+        'startup.import': result(max(imports - interpreter, 1e-6), 1, 'imports', heavy_modules=','.join(loaded) or 'none'),
+        'startup.spawn_pool': result(max(pool - imports, 1e-6), workers, 'workers'),
+    }
+
+
+def benchmark_hashing(library, repeat):
+    files = [f for f in library_files(library) if not f.endswith('.json')]
+    size = sum(os.path.getsize(f) for f in files)
+    seconds = best_of(repeat, lambda: [process.get_file_hash(f) for f in files])
+    return {'hashing': result(seconds, len(files), 'files', mb_per_second=round(size / (1024 * 1024) / seconds, 2))}
+
+
+def benchmark_thumbnails(library, repeat):
+    image_format = process.resolve_thumbnail_format('webp')
+    ext = process.thumbnail_extensions[image_format]
+    files = library_files(library)
+    kinds = {
+        'jpeg': [f for f in files if f.endswith('.jpg')],
+        'raw': [f for f in files if f.endswith('.orf')],
+        'video': [f for f in files if f.endswith('.mp4')],
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for kind, sample in kinds.items():
+            sample = sample[:THUMBNAIL_SAMPLE]
+            if not sample:
+                print(f"No {kind} files in the library, skipping thumbnails.{kind}")
+                continue
+
+            def run():
+                for i, file_path in enumerate(sample):
+                    base = os.path.join(out_dir, f"{kind}_{i}")
+                    renditions = [(f"{base}@2x{ext}", process.THUMBNAIL_2X_SIZE), (f"{base}_preview{ext}", process.PREVIEW_SIZE)]
+                    process.create_thumbnail(file_path, base + ext, process.THUMBNAIL_SIZE, renditions, image_format)
+
+            seconds = best_of(repeat, run)
+            results[f'thumbnails.{kind}'] = result(seconds, len(sample), 'files')
+    return results
+
+
+def benchmark_html_gallery(item_counts, repeat):
+    results = {}
+    for item_count in item_counts:
+        albums = synthetic_gallery_albums(item_count)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def run():
+                process.write_gallery_index(tmp_dir, albums, '.webp')
+                process.write_gallery_assets(tmp_dir)
+
+            tracemalloc.start()
+            seconds = best_of(repeat, run)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f'gallery[{item_count}]'] = result(seconds, item_count, 'items',
+                                                       peak_mb=round(peak / (1024 * 1024), 2),
+                                                       index_mb=round(directory_size(tmp_dir) / (1024 * 1024), 2))
+    return results
+
+
+def benchmark_search_index(item_counts, repeat):
+    results = {}
+    for item_count in item_counts:
+        albums = synthetic_gallery_albums(item_count)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, process.GALLERY_ASSET_DIR), exist_ok=True)
+            seconds = best_of(repeat, lambda: process.write_search_index(tmp_dir, albums))
+            results[f'search[{item_count}]'] = result(seconds, item_count, 'items')
+    return results
+
+
+def benchmark_parity(sizes_mb, repeat, fraction=0.05):
+    # Source data comes from the page cache here, so this measures encoding rather than the drive
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in sizes_mb:
+            size = size_mb * 1024 * 1024
+            data_path = os.path.join(tmp_dir, 'data.bin')
+            rng = random.Random(size_mb)
+            with open(data_path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(rng.randbytes(1024 * 1024))
+            files = [('data.bin', size)]
+            sources = [(data_path, 0, size)]
+
+            _, segments, _ = process.parity_layout(size, fraction)
+            segment_mb = segments[0]['blocks'] * process.PARITY_BLOCK_SIZE / (1024 * 1024)
+            single = best_of(repeat, lambda: process.encode_parity_segment((sources, 0, segments[0], process.PARITY_BLOCK_SIZE)))
+            results[f'parity.worker[{size_mb}]'] = result(single, segment_mb, 'MB')
+
+            parity_dir = os.path.join(tmp_dir, process.PARITY_DIR)
+            seconds = best_of(repeat, lambda: process.write_disc_parity(parity_dir, files, sources, fraction))
+            results[f'parity.pool[{size_mb}]'] = result(seconds, size_mb, 'MB')
+            os.remove(data_path)
+    return results
+
+
+STAGES = ['scan', 'dates', 'packing', 'hashing', 'thumbnails', 'gallery', 'search', 'parity', 'inventory', 'startup']
+LIBRARY_STAGES = {'scan', 'dates', 'packing', 'hashing', 'thumbnails'}
+
+
+def run_suite(scale, stages, seed, repeat, gallery_items=None, parity_mb=None, inventory_files=None):
+    settings = SCALES[scale]
+    results = {}
+    with tempfile.TemporaryDirectory() as library:
+        if LIBRARY_STAGES & set(stages):
+            print(f"Generating the {scale} library ({settings['albums']} albums x {settings['files_per_album']} files, seed {seed})...")
+            counts = generate_library(library, settings['albums'], settings['files_per_album'], seed)
+            print(f"Library: {counts}, {directory_size(library) / (1024 * 1024):.1f} MB")
+            if not tool_available('ffmpeg'):
+                print("ffmpeg not found, the library has no videos")
+        if 'scan' in stages:
+            results.update(benchmark_scan(library, repeat))
+        if 'dates' in stages:
+            results.update(benchmark_dates(library, repeat))
+        if 'packing' in stages:
+            results.update(benchmark_packing(library, repeat))
+        if 'hashing' in stages:
+            results.update(benchmark_hashing(library, repeat))
+        if 'thumbnails' in stages:
+            results.update(benchmark_thumbnails(library, repeat))
+    if 'gallery' in stages:
+        results.update(benchmark_html_gallery(gallery_items or settings['gallery_items'], repeat))
+    if 'search' in stages:
+        results.update(benchmark_search_index(gallery_items or settings['gallery_items'], repeat))
+    if 'parity' in stages:
+        results.update(benchmark_parity(parity_mb or settings['parity_mb'], repeat))
+    if 'inventory' in stages:
+        results.update(benchmark_inventory(inventory_files or settings['inventory_files'], repeat))
+    if 'startup' in stages:
+        results.update(benchmark_startup(repeat))
+    return results
+
+
+def print_results(results, baseline=None, tolerance=0.1):
+    """Print the results. With a baseline, return the cases whose rate dropped by more than tolerance."""
+    regressions = []
+    header = f"{'case':<26} {'seconds':>10} {'items':>9} {'rate':>14}"
+    print(header + (f" {'baseline':>14} {'change':>8}" if baseline else ''))
+    for name, case in results.items():
+        line = f"{name:<26} {case['seconds']:>10.4f} {case['items']:>9g} {case['rate'] or 0:>10.1f} {case['unit'] + '/s':<3}"
+        base = (baseline or {}).get(name)
+        if base and base.get('rate') and case['rate']:
+            change = case['rate'] / base['rate'] - 1
+            line += f" {base['rate']:>14.1f} {change:>+8.1%}"
+            if change < -tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        extra = {key: value for key, value in case.items() if key not in ('seconds', 'items', 'unit', 'rate')}
+        if extra:
+            line += '  ' + ' '.join(f"{key}={value}" for key, value in extra.items())
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the disc organizer pipeline on synthetic data.")
+    parser.add_argument('--scale', default='small', choices=list(SCALES), help="Size of the synthetic library and inputs (default: %(default)s)")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help="Stages to benchmark (default: all)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic library (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the fastest one counts (default: %(default)s)")
+    parser.add_argument('--items', type=int, nargs='+', help="Gallery and search item counts, instead of the scale's")
+    parser.add_argument('--parity-mb', type=int, nargs='+', help="Recovery data sizes in MB, instead of the scale's")
+    parser.add_argument('--files', type=int, nargs='+', help="File counts for the inventory memory benchmark, instead of the scale's")
+    parser.add_argument('--save', metavar='PATH', help="Save the results as a baseline JSON file")
+    parser.add_argument('--compare', metavar='PATH', help="Compare with a saved baseline, exiting with 1 if a case regressed")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Drop in rate that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = run_suite(args.scale, args.stages, args.seed, args.repeat, args.items, args.parity_mb, args.files)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('scale') != args.scale:
+            print(f"Warning: the baseline was recorded at the {saved.get('scale')} scale, not {args.scale}")
+        baseline = saved['results']
+    print()
+    regressions = print_results(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'scale': args.scale, 'seed': args.seed, 'recorded': datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(), 'machine': platform.platform(),
+                       'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+        print(f"Baseline saved to {args.save}")
+    if regressions:
+        print(f"{len(regressions)} cases are slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
@@ -1,20 +1,18 @@
+import time
+IMPORT_STARTED = time.perf_counter()
 import os
 import shutil
 from datetime import datetime
-from PIL import Image
 import json
 import sys
-from tqdm import tqdm
-from exif import Image as ExifImage
-import exiftool
 import multiprocessing
 from multiprocessing import Manager, Value, Lock, Queue, Pool
+import multiprocessing.util
 from functools import partial
 import subprocess
 from collections import defaultdict
 import hashlib
 from contextlib import contextmanager
-import time
 import heapq
 from collections import deque
 from concurrent.futures import ProcessPoolExecutor
@@ -24,9 +22,20 @@ from concurrent.futures import as_completed
 import traceback
 import logging
 import urllib.parse
-import rawpy
+import argparse
+import re
+import sqlite3
+import pathlib
+import posixpath
+import bisect
+import math
+import io
+from array import array
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning, module="PIL.Image")
+# The codec and metadata libraries (Pillow, rawpy, exiftool, tqdm, numpy) are imported by the functions that
+# use them. Pool workers re-import this module, and a copy worker or a lookup should not pay for a RAW decoder.
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 # Global variables for shared resources
 et = None
@@ -34,55 +43,571 @@ source_dir_global = None
 dest_dir_global = None
 move_files_global = False
 file_hashes = None
-log_lock = None
 
-def init_worker(shared_source_dir, shared_dest_dir, shared_move_files, shared_file_hashes, shared_log_lock):
-    global source_dir_global, dest_dir_global, move_files_global, file_hashes, log_lock
+def init_worker(shared_source_dir, shared_dest_dir, shared_move_files, shared_file_hashes, shared_inventory):
+    global source_dir_global, dest_dir_global, move_files_global, file_hashes, inventory
     source_dir_global = shared_source_dir
     dest_dir_global = shared_dest_dir
     move_files_global = shared_move_files
     file_hashes = shared_file_hashes
-    log_lock = shared_log_lock
+    inventory = shared_inventory
     
-def get_segmented_albums(source_dir, files_per_segment=300):
-    print("get_segmented_albums")
-    segmented_albums = []
-    for root, _, _ in os.walk(source_dir):
-        if 'thumbs' in root or 'exiftool_files' in root or 'ignore' in root:
-            continue
-        
+# Run report. Every stage of a run records wall and CPU time, files, bytes and per-file latencies, so a
+# long run shows where the time went. Pool workers time their own tasks through timed_task.
+class StageStats:
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def summary(self):
+        summary = {
+            'wall_seconds': round(self.wall_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'files': self.files,
+            'bytes': self.bytes,
+        }
+        if self.wall_seconds > 0:
+            summary['files_per_second'] = round(self.files / self.wall_seconds, 2)
+            summary['mb_per_second'] = round(self.bytes / (1024 * 1024) / self.wall_seconds, 2)
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            for name, quantile in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+                summary[f'latency_{name}_seconds'] = round(latencies[min(len(latencies) - 1, int(quantile * len(latencies)))], 6)
+        return summary
+
+class RunReport:
+    def __init__(self):
+        self.started = datetime.now()
+        self.stages = defaultdict(StageStats)
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage in this process. Work done by pool workers is added with record()."""
+        stats = self.stages[name]
+        stop_profiler = start_profiler(name, profile_mode, profile_dir) if profile_mode else None
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.wall_seconds += time.perf_counter() - start
+            stats.cpu_seconds += time.process_time() - cpu
+            if stop_profiler:
+                stop_profiler()
+
+    def record(self, name, seconds=None, cpu_seconds=0.0, files=1, size=0):
+        stats = self.stages[name]
+        stats.cpu_seconds += cpu_seconds
+        stats.files += files
+        stats.bytes += size
+        if seconds is not None:
+            stats.latencies.append(seconds)
+
+    def summary(self):
+        finished = datetime.now()
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': finished.isoformat(timespec='seconds'),
+            'wall_seconds': round((finished - self.started).total_seconds(), 3),
+            'stages': {name: stats.summary() for name, stats in self.stages.items()},
+        }
+
+    def write(self, report_path, prometheus_path=None, **details):
+        summary = self.summary()
+        summary.update(details)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        if prometheus_path:
+            write_prometheus_textfile(prometheus_path, summary)
+        return summary
+
+PROMETHEUS_METRICS = [
+    ('wall_seconds', 'Wall time spent in the stage'),
+    ('cpu_seconds', 'CPU time spent in the stage, including pool workers'),
+    ('files', 'Files handled by the stage'),
+    ('bytes', 'Bytes handled by the stage'),
+]
+
+def write_prometheus_textfile(path, summary):
+    lines = []
+    for key, help_text in PROMETHEUS_METRICS:
+        metric = f"bluberry_stage_{key}"
+        lines += [f"# HELP {metric} {help_text}.", f"# TYPE {metric} gauge"]
+        lines += [f'{metric}{{stage="{name}"}} {stats[key]}' for name, stats in summary['stages'].items()]
+    metric = "bluberry_stage_latency_seconds"
+    lines += [f"# HELP {metric} Per-file latency in the stage.", f"# TYPE {metric} summary"]
+    for name, stats in summary['stages'].items():
+        for label, quantile in (('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99')):
+            if f'latency_{label}_seconds' in stats:
+                lines.append(f'{metric}{{stage="{name}",quantile="{quantile}"}} {stats[f"latency_{label}_seconds"]}')
+    lines += ["# HELP bluberry_run_wall_seconds Wall time of the whole run.", "# TYPE bluberry_run_wall_seconds gauge",
+              f"bluberry_run_wall_seconds {summary['wall_seconds']}"]
+    # The node exporter may read the file at any time, so it is replaced in one step
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+
+run_report = RunReport()
+
+def timed_task(func, args):
+    """Run func(args) in a pool worker, returning (result, wall seconds, CPU seconds of the worker)."""
+    start, cpu = time.perf_counter(), time.process_time()
+    result = func(args)
+    return result, time.perf_counter() - start, time.process_time() - cpu
+
+# Events. Every process logs through the logging module; pool workers hand their records to one queue
+# (set up by the pool initializer) and a single writer thread in the main process drains it in batches.
+# Each batch is appended to events.jsonl, records carrying a 'processed' line go to processed_files.log,
+# and INFO and above is shown on the console above the progress bars.
+event_queue = None
+
+class EventWriter:
+    def __init__(self, queue, events_path, processed_path, interval=0.5, batch_size=2000):
+        import threading
+        self.queue = queue
+        self.events_path = events_path
+        self.processed_path = processed_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _next_batch(self):
+        import queue
+        try:
+            batch = [self.queue.get(timeout=self.interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with open(self.events_path, 'a', encoding='utf-8') as events, \
+                open(self.processed_path, 'a', encoding='utf-8') as processed:
+            stopping = False
+            while not stopping:
+                for record in self._next_batch():
+                    if record is None:
+                        stopping = True
+                        continue
+                    event = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                             'level': record.levelname, 'process': record.processName, 'message': record.getMessage()}
+                    if hasattr(record, 'processed'):
+                        event['processed'] = record.processed
+                        processed.write(record.processed + '\n')
+                    events.write(json.dumps(event) + '\n')
+                    if hasattr(record, 'startup'):
+                        run_report.record(f"startup.{record.startup[0]}", record.startup[1], files=0)
+                    if record.levelno >= logging.INFO:
+                        from tqdm import tqdm
+                        tqdm.write(record.getMessage())
+                events.flush()
+                processed.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+def route_logging(queue):
+    """Send every log record of this process to the event queue."""
+    import logging.handlers
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(logging.DEBUG)
+    # The imaging libraries' own debug chatter would otherwise drown out the per-file events
+    logging.getLogger('PIL').setLevel(logging.INFO)
+
+def start_event_log(dest_dir):
+    """Route this process's logging to a new event queue and writer; returns the function that stops them."""
+    global event_queue
+    event_queue = multiprocessing.Queue()
+    writer = EventWriter(event_queue, os.path.join(dest_dir, 'events.jsonl'), os.path.join(dest_dir, 'processed_files.log'))
+    root = logging.getLogger()
+    previous_handlers, previous_level = list(root.handlers), root.level
+    route_logging(event_queue)
+
+    def stop_event_log():
+        global event_queue
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in previous_handlers:
+            root.addHandler(handler)
+        root.setLevel(previous_level)
+        writer.close()
+        event_queue = None
+    return stop_event_log
+
+# Profiling. With --profile, every stage is profiled in this process and in each of its pool workers,
+# which start a profiler from the pool initializer and dump it when they exit. The dumps are merged per
+# stage at the end of the run. 'cprofile' gives exact call counts; 'sample' records the stack every few
+# milliseconds from a background thread, which is cheap enough to leave on for a whole run.
+profile_mode = None
+profile_dir = None
+active_profiler = None
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a background thread, in flame graph (folded) format."""
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        import threading
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.items():
+                f.write(f"{stack} {count}\n")
+
+class CallProfiler:
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+PROFILERS = {'cprofile': (CallProfiler, '.prof'), 'sample': (StackSampler, '.folded')}
+
+def start_profiler(stage, mode, directory):
+    """Profile this process until it exits or stop_profiler is called; returns a callable that stops it
+    and writes the dump, or None if a profiler is already running here."""
+    global active_profiler
+    if active_profiler is not None:
+        return None
+    profiler_class, ext = PROFILERS[mode]
+    profiler = profiler_class()
+    active_profiler = profiler
+    # Pool workers of successive discs can get the same pid, so the time makes every dump unique
+    path = os.path.join(directory, 'raw', f"{stage}-{os.getpid()}-{time.time_ns()}{ext}")
+
+    def stop_profiler():
+        global active_profiler
+        profiler.stop()
+        profiler.dump(path)
+        active_profiler = None
+    return stop_profiler
+
+def init_pool_worker(stage, queue, mode, directory, initializer, initargs, created):
+    global active_profiler
+    if queue is not None:
+        route_logging(queue)
+        # From the pool's creation until this worker could take a task: spawning it, importing this module and
+        # unpickling its arguments (the inventory, for most stages)
+        startup = time.time() - created
+        logging.debug(f"Worker for {stage} started in {startup:.3f}s",
+                      extra={'startup': (stage, startup)})
+    if mode:
+        if active_profiler is not None:
+            # A forked worker inherits the parent's profiler, whose results belong to the parent
+            active_profiler.stop()
+            active_profiler = None
+        stop_profiler = start_profiler(stage, mode, directory)
+        # Runs when the worker exits normally, which is why pools are closed and joined instead of terminated
+        multiprocessing.util.Finalize(None, stop_profiler, exitpriority=100)
+    if initializer is not None:
+        initializer(*initargs)
+
+def pool_initializer(stage, initializer=None, initargs=()):
+    """initializer/initargs keyword arguments for a stage's worker pool, adding the event queue and the
+    profiler when they are enabled."""
+    if event_queue is None and profile_mode is None:
+        return {'initializer': initializer, 'initargs': initargs}
+    return {'initializer': init_pool_worker,
+            'initargs': (stage, event_queue, profile_mode, profile_dir, initializer, initargs, time.time())}
+
+def merge_profiles(directory):
+    """Merge the raw per-process dumps into one profile per stage, returning the files written."""
+    import pstats
+    raw_dir = os.path.join(directory, 'raw')
+    by_stage = defaultdict(list)
+    for name in sorted(os.listdir(raw_dir)):
+        stage = name.rsplit('-', 2)[0]
+        by_stage[(stage, os.path.splitext(name)[1])].append(os.path.join(raw_dir, name))
+
+    written = []
+    for (stage, ext), paths in sorted(by_stage.items()):
+        merged_path = os.path.join(directory, stage + ext)
+        if ext == '.prof':
+            stats = pstats.Stats(paths[0])
+            for path in paths[1:]:
+                stats.add(path)
+            stats.dump_stats(merged_path)
+            with open(os.path.join(directory, stage + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(f"{stage}: merged from {len(paths)} processes\n")
+                pstats.Stats(merged_path, stream=f).sort_stats('cumulative').print_stats(40)
+        else:
+            counts = defaultdict(int)
+            for path in paths:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        counts[stack] += int(count)
+            with open(merged_path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+        written.append(merged_path)
+    return written
+
+# File inventory. Every source file is one row, stored column-wise instead of as per-file tuples, so a
+# library of millions of files fits in memory and is handed to the pool workers once rather than pickled
+# per task. Names are UTF-8 in a single buffer, album and segment names are interned tables, and sizes,
+# mtimes and dates are typed arrays. Stages pass row numbers (or a segment's range of rows) around.
+class FileInventory:
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.albums = []                  # album path relative to the source, '.' for the source itself
+        self.segments = []                # segment name, which is also the segment's folder on a disc
+        self.segment_album = array('I')
+        self.segment_start = array('q')   # a segment's rows are contiguous
+        self.names = bytearray()
+        self.name_end = array('q')
+        self.album = array('I')
+        self.segment = array('I')
+        self.size = array('q')
+        self.mtime = array('d')
+        self.date = array('d')            # POSIX timestamp of the date taken, NaN until it is known
+        self.width = array('I')           # upright pixel dimensions, 0 when unknown
+        self.height = array('I')
+        self.duration = array('f')        # seconds of video, NaN for stills or when unknown
+        self.cameras = ['']               # interned camera names, '' for unknown
+        self.camera = array('I')
+        self.camera_ids = {'': 0}
+
+    def __len__(self):
+        return len(self.size)
+
+    def add_album(self, album_name):
+        self.albums.append(album_name)
+        return len(self.albums) - 1
+
+    def add_segment(self, segment_name, album_id):
+        self.segments.append(segment_name)
+        self.segment_album.append(album_id)
+        self.segment_start.append(len(self))
+        return len(self.segments) - 1
+
+    def add_file(self, name, size, mtime):
+        """Append a file to the most recently added segment."""
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.name_end.append(len(self.names))
+        self.album.append(self.segment_album[-1])
+        self.segment.append(len(self.segments) - 1)
+        self.size.append(size)
+        self.mtime.append(mtime)
+        self.date.append(math.nan)
+        self.width.append(0)
+        self.height.append(0)
+        self.duration.append(math.nan)
+        self.camera.append(0)
+
+    def set_metadata(self, segment_id, dates, widths, heights, durations, cameras):
+        """Store what get_segment_metadata read for a segment."""
+        rows = self.segment_rows(segment_id)
+        self.date[rows.start:rows.stop] = dates
+        self.width[rows.start:rows.stop] = widths
+        self.height[rows.start:rows.stop] = heights
+        self.duration[rows.start:rows.stop] = durations
+        for row, camera in zip(rows, cameras):
+            camera = camera or ''
+            if camera not in self.camera_ids:
+                self.camera_ids[camera] = len(self.cameras)
+                self.cameras.append(camera)
+            self.camera[row] = self.camera_ids[camera]
+
+    def name(self, row):
+        start = self.name_end[row - 1] if row else 0
+        return self.names[start:self.name_end[row]].decode('utf-8', 'surrogateescape')
+
+    def segment_rows(self, segment_id):
+        stop = self.segment_start[segment_id + 1] if segment_id + 1 < len(self.segments) else len(self)
+        return range(self.segment_start[segment_id], stop)
+
+    def source_path(self, row):
+        """Path of the file on the filesystem, relative to the source directory."""
+        return os.path.join(self.albums[self.album[row]], self.name(row))
+
+    def catalog_path(self, row):
+        return catalog_source_path(self.albums[self.album[row]], self.name(row))
+
+    def disc_path(self, row):
+        return os.path.normpath(os.path.join(self.segments[self.segment[row]], self.name(row))).replace(os.sep, '/')
+
+    def date_taken(self, row):
+        timestamp = self.date[row]
+        return None if math.isnan(timestamp) else datetime.fromtimestamp(timestamp)
+
+    def media_info(self, row):
+        """(date taken, width, height, duration, camera) of a file, None where unknown, as get_media_info returns it."""
+        duration = self.duration[row]
+        return (self.date_taken(row), self.width[row] or None, self.height[row] or None,
+                None if math.isnan(duration) else round(duration, 2), self.cameras[self.camera[row]] or None)
+
+    def reorder(self, order, segments):
+        """Put the rows in the given order and replace the segments with (name, album id, first row) in
+        that order. Rows keep their album, so each album's rows must stay contiguous."""
+        import numpy as np
+        order = np.asarray(order, dtype=np.int64)
+        name_end = self.column('name_end')
+        name_start = np.r_[0, name_end[:-1]] if len(name_end) else name_end
+        names = memoryview(self.names)
+        self.names = bytearray(b''.join([names[start:end] for start, end in zip(name_start[order].tolist(), name_end[order].tolist())]))
+        names.release()
+        self.name_end = array('q', np.cumsum(name_end[order] - name_start[order]).tobytes())
+        for name in ('album', 'size', 'mtime', 'date', 'width', 'height', 'duration', 'camera'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, self.column(name)[order].tobytes()))
+        self.segments = [segment_name for segment_name, _, _ in segments]
+        self.segment_album = array('I', [album_id for _, album_id, _ in segments])
+        self.segment_start = array('q', [first for _, _, first in segments])
+        counts = np.diff(np.r_[self.column('segment_start'), len(self)])
+        self.segment = array('I', np.repeat(np.arange(len(segments), dtype=np.uint32), counts).tobytes())
+
+    def column(self, name):
+        """A column as a NumPy array sharing the inventory's memory."""
+        import numpy as np
+        column = getattr(self, name)
+        return np.frombuffer(column, dtype=np.dtype(column.typecode)) if len(column) else np.empty(0, column.typecode)
+
+    def total_size(self, rows):
+        import numpy as np
+        return int(self.column('size')[np.asarray(rows, dtype=np.intp)].sum()) if len(rows) else 0
+
+    def nbytes(self):
+        columns = (self.segment_album, self.segment_start, self.name_end, self.album, self.segment,
+                   self.size, self.mtime, self.date, self.width, self.height, self.duration, self.camera)
+        return (len(self.names) + sum(column.itemsize * len(column) for column in columns)
+                + sum(sys.getsizeof(name) for name in self.albums + self.segments + self.cameras))
+
+def scan_inventory(source_dir, files_per_segment=300, archived=None):
+    """Walk source_dir into a FileInventory, splitting albums into segments of files_per_segment files. These
+    are the batches of the metadata pass; segment_inventory re-cuts them for packing once the dates are known.
+    With archived (from load_archived_files), files unchanged since they were archived are left out.
+    Returns (inventory, number of files left out)."""
+    logging.debug("scan_inventory")
+    inventory = FileInventory(source_dir)
+    skipped = 0
+    for root, dirs, _ in os.walk(source_dir):
+        # Prune folders by their exact name, so an album such as "Client previews 2019" is still scanned
+        dirs[:] = [d for d in dirs if d not in {'thumbs', 'previews', PROXY_DIR, 'exiftool_files', 'ignore'}]
+
         album_name = os.path.relpath(root, source_dir)
-        album_files = [f for f in os.listdir(root) if os.path.splitext(f)[1].lower() in all_extensions or f.endswith('.json')]
-        
-        # Segment the album if it has more than files_per_segment files
-        maxSeg = 0
+        album_files = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() in all_extensions or entry.name.endswith('.json'):
+                    stats = entry.stat()
+                    if archived is not None:
+                        previous = archived.get(catalog_source_path(album_name, entry.name))
+                        if previous is not None:
+                            size, mtime = previous
+                            if stats.st_size == size and mtime is not None and abs(stats.st_mtime - mtime) < 0.001:
+                                skipped += 1
+                                continue
+                    album_files.append((entry.name, stats.st_size, stats.st_mtime))
+        if not album_files:
+            continue
+
+        album_id = inventory.add_album(album_name)
         for i in range(0, len(album_files), files_per_segment):
-            segment = album_files[i:i+files_per_segment]
-            segment_name = f"{album_name}_{i//files_per_segment + 1}" if i > 0 else album_name
-            segmented_albums.append((root, album_name, segment_name, segment))
-            maxSeg = i
-        if maxSeg:
-            print("Segmented folder "+str(maxSeg)+" times")
-            
-    
-    return segmented_albums
-    
-def get_album_structure(album):
-    album_name, segment_name, total_size, _, _, _, album_root, file_list = album
-    structure = {}
-    for filename in file_list:
-        file_path = os.path.join(album_root, filename)
-        file_size = os.path.getsize(file_path)
-        relative_path = filename  # Since file_list contains relative paths
-        year_month = os.path.dirname(relative_path)
-        if year_month not in structure:
-            structure[year_month] = []
-        structure[year_month].append((relative_path, file_size))
-    return album_name, segment_name, structure, total_size
+            inventory.add_segment(f"{album_name}_{i//files_per_segment + 1}" if i > 0 else album_name, album_id)
+            for name, size, mtime in album_files[i:i+files_per_segment]:
+                inventory.add_file(name, size, mtime)
+
+    return inventory, skipped
+
+# Segmentation. Once the metadata pass has dated every file, each album is sorted by capture date and cut
+# into segments no larger than a share of a disc, preferring natural breaks in the dates, so the packer
+# mostly places whole segments instead of splitting albums file by file.
+SEGMENT_DISC_SHARE = 0.5               # largest segment, as a share of the packing capacity
+SEGMENT_MIN_FILL = 0.5                 # a segment is only cut at a time gap once it holds this share of the budget
+SEGMENT_TIME_GAP = 3 * 24 * 60 * 60    # seconds between two captures that count as a natural break
+
+def segment_inventory(inventory, budget, time_gap=SEGMENT_TIME_GAP, min_fill=SEGMENT_MIN_FILL, reserve=None):
+    """Re-cut every album of inventory into date-ordered segments of at most budget bytes. Albums that fit
+    in the budget stay whole; larger ones are cut at the first time gap past min_fill of the budget, or
+    when the next file would not fit. reserve adds bytes per row, as from proxy_reserve, and is reordered
+    along with the rows. Returns (number of albums that were split, reserve)."""
+    import numpy as np
+    sizes = inventory.column('size') if reserve is None else inventory.column('size') + reserve
+    dates = inventory.column('date')
+    album_ids = inventory.column('album')
+    order = np.empty(len(inventory), dtype=np.int64)
+    segments = []
+    split = 0
+    # Rows of an album are contiguous, as scan_inventory adds them album by album
+    album_starts = np.flatnonzero(np.r_[True, album_ids[1:] != album_ids[:-1]]) if len(inventory) else []
+    album_stops = list(album_starts[1:]) + [len(inventory)]
+    for start, stop in zip(album_starts, album_stops):
+        album_id = int(album_ids[start])
+        album_name = inventory.albums[album_id]
+        # Oldest first, undated files last, scan order between equal dates
+        album_dates = dates[start:stop]
+        rows = np.lexsort((np.arange(start, stop), np.nan_to_num(album_dates, nan=np.inf))) + start
+        order[start:stop] = rows
+        album_sizes = sizes[rows]
+        parts = [0]
+        if album_sizes.sum() > budget:
+            ordered_dates = dates[rows]
+            gaps = np.r_[np.diff(ordered_dates), 0] >= time_gap
+            filled = 0
+            for i, size in enumerate(album_sizes.tolist()):
+                if filled and filled + size > budget:
+                    parts.append(i)
+                    filled = 0
+                filled += size
+                if gaps[i] and filled >= budget * min_fill and i + 1 < len(rows):
+                    parts.append(i + 1)
+                    filled = 0
+            split += 1
+            logging.info(f"Segmented folder {album_name} into {len(parts)} parts")
+        for part, first in enumerate(parts):
+            segments.append((f"{album_name}_{part + 1}" if part else album_name, album_id, start + first))
+    inventory.reorder(order, segments)
+    return split, None if reserve is None else reserve[order]
+
+# Set in the main process and in pool workers (through init_inventory or init_worker)
+inventory = None
+
+def init_inventory(shared_inventory):
+    global inventory
+    inventory = shared_inventory
 
 @contextmanager
 def exiftool_context():
     global et
+    import exiftool
     et = exiftool.ExifToolHelper()
     try:
         yield et
@@ -110,6 +635,7 @@ raw_image_extensions = {'.orf', '.raw', '.cr2', '.nef', '.arw', '.dng', '.raf',
 
 skip_files = {'hash_manifest.json', 'index.html'}
 all_extensions = image_extensions.union(video_extensions).union(raw_video_extensions)
+rendition_extensions = all_extensions | raw_image_extensions  # files the gallery writes thumbnails and a preview for
 
 def create_manifest_file(directory):
     manifest = defaultdict(list)
@@ -119,12 +645,15 @@ def create_manifest_file(directory):
                 continue
             file_path = os.path.join(root, file)
             relative_path = os.path.relpath(file_path, directory)
+            start = time.perf_counter()
             file_hash = get_file_hash(file_path)
+            run_report.record('manifest', time.perf_counter() - start, size=os.path.getsize(file_path))
             manifest[file_hash].append(relative_path)
     
     manifest_path = os.path.join(directory, 'hash_manifest.json')
     with open(manifest_path, 'w', encoding='utf-8') as f:
         json.dump(manifest, f, indent=2)
+    return manifest
  
 
 
@@ -138,6 +667,39 @@ def get_file_hash(file_path, block_size=65536):
     return hasher.hexdigest()
     
 def get_date_taken(file_path):
+    return get_media_info(file_path)[0]
+
+# exiftool tags read for the gallery, first match wins. Numeric values, since the helper runs exiftool with -n.
+DIMENSION_TAGS = [('File:ImageWidth', 'File:ImageHeight'), ('EXIF:ExifImageWidth', 'EXIF:ExifImageHeight'),
+                  ('QuickTime:ImageWidth', 'QuickTime:ImageHeight'), ('Matroska:ImageWidth', 'Matroska:ImageHeight'),
+                  ('RIFF:ImageWidth', 'RIFF:ImageHeight')]
+DURATION_TAGS = ['QuickTime:Duration', 'Matroska:Duration', 'RIFF:Duration', 'Composite:Duration']
+
+def media_details(metadata):
+    """(width, height, duration in seconds, camera) from exiftool metadata; unknown values are None."""
+    width = height = duration = None
+    for width_tag, height_tag in DIMENSION_TAGS:
+        try:
+            width, height = int(metadata[width_tag]), int(metadata[height_tag])
+            break
+        except (KeyError, TypeError, ValueError):
+            continue
+    # Thumbnails and previews are shown upright, so report the dimensions the same way
+    if width and (metadata.get('EXIF:Orientation') in (5, 6, 7, 8) or metadata.get('Composite:Rotation') in (90, 270)):
+        width, height = height, width
+    for tag in DURATION_TAGS:
+        try:
+            duration = float(metadata[tag])
+            break
+        except (KeyError, TypeError, ValueError):
+            continue
+    make = str(metadata.get('EXIF:Make') or metadata.get('QuickTime:Make') or '').strip()
+    model = str(metadata.get('EXIF:Model') or metadata.get('QuickTime:Model') or '').strip()
+    camera = model if model.lower().startswith(make.lower()) else f"{make} {model}".strip()
+    return width, height, duration, camera or None
+
+def get_media_info(file_path):
+    """Return (date taken, width, height, duration, camera) for a file, with None for what is unknown."""
     global et
     file_ext = os.path.splitext(file_path)[1].lower()
     
@@ -150,36 +712,38 @@ def get_date_taken(file_path):
                 # First, try to get photoTakenTime
                 if 'photoTakenTime' in json_data and 'timestamp' in json_data['photoTakenTime']:
                     try:
-                        return datetime.fromtimestamp(int(json_data['photoTakenTime']['timestamp']))
+                        return (datetime.fromtimestamp(int(json_data['photoTakenTime']['timestamp'])), None, None, None, None)
                     except (ValueError, OSError, OverflowError) as e:
-                        print(f" Error parsing photoTakenTime for {file_path}: {e}")
+                        logging.warning(f"Error parsing photoTakenTime for {file_path}: {e}")
                 
                 # If photoTakenTime is not available or invalid, try creationTime
                 if 'creationTime' in json_data and 'timestamp' in json_data['creationTime']:
                     try:
-                        return datetime.fromtimestamp(int(json_data['creationTime']['timestamp']))
+                        return (datetime.fromtimestamp(int(json_data['creationTime']['timestamp'])), None, None, None, None)
                     except (ValueError, OSError, OverflowError) as e:
-                        print(f" Error parsing creationTime for {file_path}: {e}")
+                        logging.warning(f"Error parsing creationTime for {file_path}: {e}")
                 
-                print(f" No valid date found in JSON for {file_path}")
+                logging.debug(f"No valid date found in JSON for {file_path}")
         except json.JSONDecodeError as e:
-            print(f" Error decoding JSON for {file_path}: {e}")
+            logging.warning(f"Error decoding JSON for {file_path}: {e}")
         except Exception as e:
-            print(f" Error reading JSON data for {file_path}: {e}")
+            logging.warning(f"Error reading JSON data for {file_path}: {e}")
     
     # Use exiftool for all image and video types
+    details = (None, None, None, None)
     with exiftool_context() as et:
         try:
             metadata = et.get_metadata(file_path)[0]
+            details = media_details(metadata)
             for tag in ['EXIF:DateTimeOriginal', 'EXIF:CreateDate', 'QuickTime:CreateDate', 'File:FileModifyDate']:
                 date_str = metadata.get(tag)
                 if date_str:
                     try:
-                        return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
+                        return (datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S"),) + details
                     except ValueError:
                         pass  # If parsing fails, try the next tag
         except Exception as e:
-            print(f" Error reading metadata for {file_path}: {e}")
+            logging.warning(f"Error reading metadata for {file_path}: {e}")
         finally:
             time.sleep(0.01)  # Add a small delay to prevent potential ExifTool issues
     
@@ -187,759 +751,2787 @@ def get_date_taken(file_path):
     try:
         mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
         create_time = datetime.fromtimestamp(os.path.getctime(file_path))
-        return min(mod_time, create_time)
+        return (min(mod_time, create_time),) + details
     except Exception as e:
-        print(f" Error getting file system times for {file_path}: {e}")
+        logging.warning(f"Error getting file system times for {file_path}: {e}")
     
     # If even this fails, return None
-    return None
-    
-def get_album_info(album_data):
-    root, album_name, segment_name, file_list = album_data
-    print(f" Processing album segment: {segment_name}")  # Debug print
-    
-    album_size = sum(os.path.getsize(os.path.join(root, f)) for f in file_list)
+    return (None,) + details
     
-    earliest_date = datetime.max
-    latest_date = datetime.min
-    
-    for file in file_list:
-        file_path = os.path.join(root, file)
+def get_segment_metadata(segment_id):
+    """Read the date and details of every file of a segment. Returns (segment id, dates as timestamps, widths,
+    heights, durations, cameras, per-file seconds), with 0, NaN or None where a value is unknown."""
+    segment_name = inventory.segments[segment_id]
+    logging.debug(f"Processing album segment: {segment_name}")
+    dates = array('d')
+    widths = array('I')
+    heights = array('I')
+    durations = array('f')
+    cameras = []
+    file_seconds = []
+
+    for row in inventory.segment_rows(segment_id):
+        file_path = os.path.join(inventory.source_dir, inventory.source_path(row))
+        date_taken, width, height, duration, camera = None, None, None, None, None
+        start = time.perf_counter()
         try:
-            date_taken = get_date_taken(file_path)
-            if isinstance(date_taken, datetime):
-                earliest_date = min(earliest_date, date_taken)
-                latest_date = max(latest_date, date_taken)
+            date_taken, width, height, duration, camera = get_media_info(file_path)
         except Exception as e:
-            print(f" Error getting date for {file_path}: {e}")
-    
-    if earliest_date == datetime.max:
-        earliest_date = latest_date = datetime.now()
-    
-    print(f" Finished processing album segment: {segment_name}")  # Debug print
-    return (album_name, segment_name, album_size, earliest_date, latest_date, len(file_list), root, file_list)
+            logging.warning(f"Error getting date for {file_path}: {e}")
+        # Failures count too, so the latencies cover every file and not just the ones that could be read
+        file_seconds.append(time.perf_counter() - start)
+        dates.append(date_taken.timestamp() if isinstance(date_taken, datetime) else math.nan)
+        widths.append(width or 0)
+        heights.append(height or 0)
+        durations.append(math.nan if duration is None else duration)
+        cameras.append(camera)
 
-def create_thumbnail(file_path, thumb_path, size=(200, 200)):
-    try:
-        file_ext = os.path.splitext(file_path)[1].lower()
-        
-        if file_ext in raw_image_extensions:
-            try:
-                # First, try using rawpy
-                with rawpy.imread(file_path) as raw:
-                    rgb = raw.postprocess()
-                image = Image.fromarray(rgb)
-                image.thumbnail(size)
-                image.save(thumb_path, 'JPEG', quality=85)
-                print(f"Thumbnail created with rawpy for {file_path}")
-                return
-            except Exception as e:
-                print(f"rawpy failed for {file_path}: {e}")
-                
-            try:
-                # If rawpy fails, try using ffmpeg
-                command = [
-                    'ffmpeg',
-                    '-i', file_path,
-                    '-vf', f'scale={size[0]}:{size[1]}:force_original_aspect_ratio=decrease,pad={size[0]}:{size[1]}:(ow-iw)/2:(oh-ih)/2',
-                    '-frames:v', '1',
-                    '-y',
-                    thumb_path
-                ]
-                subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                print(f"Thumbnail created with ffmpeg for {file_path}")
-                return
-            except subprocess.CalledProcessError as e:
-                print(f"ffmpeg failed for {file_path}: {e}")
-        
-        elif file_ext in image_extensions:
+    logging.debug(f"Finished processing album segment: {segment_name}")
+    return segment_id, dates, widths, heights, durations, cameras, file_seconds
+
+# Renditions written for every gallery item. All of them come from a single decode of the original.
+THUMBNAIL_SIZE = (200, 200)
+THUMBNAIL_2X_SIZE = (400, 400)
+PREVIEW_SIZE = (1600, 1600)
+
+thumbnail_extensions = {'WEBP': '.webp', 'AVIF': '.avif', 'JPEG': '.jpg'}
+thumbnail_save_options = {
+    'WEBP': {'quality': 80, 'method': 4},
+    'AVIF': {'quality': 60},
+    'JPEG': {'quality': 85},
+}
+# What the renditions of a photograph take at the qualities above, with some margin, for the packing reserve
+rendition_bytes_per_pixel = {'WEBP': 0.25, 'AVIF': 0.15, 'JPEG': 0.4}
+RENDITION_FILE_OVERHEAD = 4096  # per rendition file: container headers and filesystem block rounding
+
+def rendition_reserve(inventory, thumbnail_format='WEBP', preview_size=PREVIEW_SIZE):
+    """Bytes to set aside on a disc for the thumbnails and preview of each file of inventory, from its
+    dimensions when the metadata pass found them, or a 4:3 frame filling each box otherwise."""
+    import numpy as np
+    widths = inventory.column('width').astype(np.float64)
+    heights = inventory.column('height').astype(np.float64)
+    long_edges = np.maximum(widths, heights)
+    known = (widths > 0) & (heights > 0)
+    pixels = np.zeros(len(inventory))
+    for box in (THUMBNAIL_SIZE, THUMBNAIL_2X_SIZE, preview_size):
+        edge = max(box)
+        scale = np.minimum(1.0, edge / np.where(known, long_edges, 1.0))
+        pixels += np.where(known, widths * heights * scale * scale, edge * edge * 0.75)
+    reserve = (pixels * rendition_bytes_per_pixel[thumbnail_format] + 3 * RENDITION_FILE_OVERHEAD).astype(np.int64)
+    has_renditions = np.fromiter((os.path.splitext(inventory.name(row))[1].lower() in rendition_extensions
+                                  for row in range(len(inventory))), dtype=bool, count=len(inventory))
+    return np.where(has_renditions, reserve, 0)
+
+def resolve_thumbnail_format(name):
+    image_format = name.upper()
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    if image_format not in thumbnail_extensions:
+        raise ValueError(f"Unsupported thumbnail format: {name}")
+    if image_format == 'AVIF':
+        try:
+            import pillow_avif  # noqa: F401 -- registers the AVIF plugin on older Pillow releases
+        except ImportError:
+            pass
+    from PIL import Image
+    Image.init()
+    if image_format not in Image.SAVE:
+        logging.warning(f"This Pillow build cannot write {image_format}, falling back to JPEG thumbnails")
+        image_format = 'JPEG'
+    return image_format
+
+heif_registered = False
+
+def import_pil():
+    """Pillow's Image and ImageOps, registering the optional HEIC opener on first use."""
+    global heif_registered
+    from PIL import Image, ImageOps
+    if not heif_registered:
+        heif_registered = True
+        try:
+            # Optional: lets Pillow decode .heic originals so they get real previews
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            pass
+    return Image, ImageOps
+
+def decode_with_ffmpeg(file_path, seek=None):
+    Image, _ = import_pil()
+    command = ['ffmpeg', '-v', 'error']
+    if seek:
+        command += ['-ss', seek]
+    command += ['-i', file_path, '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout:
+        raise Exception(f"FFmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    image = Image.open(io.BytesIO(result.stdout))
+    image.load()
+    return image
+
+def decode_media(file_path, max_size=PREVIEW_SIZE):
+    """Decode a source file once, returning (image, decoder) or (None, None) for unknown formats."""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    Image, ImageOps = import_pil()
+
+    if file_ext in raw_image_extensions:
+        try:
+            import rawpy
+            # Half-size demosaicing is still larger than any rendition we write, and much faster
+            with rawpy.imread(file_path) as raw:
+                rgb = raw.postprocess(half_size=True)
+            return Image.fromarray(rgb), 'rawpy'
+        except Exception as e:
+            logging.debug(f"rawpy failed for {file_path}: {e}")
+        return decode_with_ffmpeg(file_path), 'ffmpeg'
+
+    if file_ext in image_extensions:
+        try:
             with Image.open(file_path) as img:
-                # Convert to RGB if the image is in RGBA mode
-                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                    bg = Image.new('RGB', img.size, (255, 255, 255))
-                    bg.paste(img, mask=img.split()[3] if img.mode == 'RGBA' else None)
-                    img = bg
+                # Let the JPEG decoder scale down while decoding, we never need more than max_size
+                img.draft('RGB', max_size)
+                img.load()
+                image = ImageOps.exif_transpose(img)
+            return image, 'pil'
+        except Exception as e:
+            logging.debug(f"PIL failed for {file_path}: {e}")
+        return decode_with_ffmpeg(file_path), 'ffmpeg'
 
-                img.thumbnail(size)
-                
-                # Save as PNG if original is PNG or GIF, otherwise save as JPEG
-                if file_ext in ('.png', '.gif'):
-                    img.save(thumb_path, 'PNG')
-                else:
-                    img.save(thumb_path, 'JPEG', quality=85)
-            print(f"Thumbnail created with PIL for {file_path}")
-            return
-            
-        elif file_ext in video_extensions or file_ext in raw_video_extensions:
-            # Use FFmpeg to create a thumbnail for videos
-            command = [
-                'ffmpeg',
-                '-i', file_path,
-                '-ss', '00:00:01.000',
-                '-vframes', '1',
-                '-vf', f'scale={size[0]}:{size[1]}:force_original_aspect_ratio=decrease,pad={size[0]}:{size[1]}:(ow-iw)/2:(oh-ih)/2',
-                '-y',
-                thumb_path
-            ]
-            try:
-                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-                if result.returncode != 0:
-                    # FFmpeg failed
-                    error_message = result.stderr
-                    print(f"\nError creating thumbnail for {file_path}: {error_message}")
-                    raise Exception("FFmpeg failed")
-            except Exception as e:
-                print(f"\nError creating thumbnail for {file_path}: {e}")
-                # Create a placeholder thumbnail
-                with Image.new('RGB', size, color='red') as img:
-                    img.save(thumb_path, 'JPEG')
-        else:
+    if file_ext in video_extensions or file_ext in raw_video_extensions:
+        try:
+            return decode_with_ffmpeg(file_path, seek='00:00:01.000'), 'ffmpeg'
+        except Exception:
+            # Clips shorter than a second have no frame at the seek point
+            return decode_with_ffmpeg(file_path), 'ffmpeg'
+
+    return None, None
+
+def flatten_image(image):
+    # Composite transparency onto white so every codec gets a plain RGB image
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        from PIL import Image
+        image = image.convert('RGBA')
+        bg = Image.new('RGB', image.size, (255, 255, 255))
+        bg.paste(image, mask=image.split()[3])
+        return bg
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+def save_renditions(image, renditions, image_format):
+    # Largest first, so each smaller rendition is resampled from the previous one instead of the original
+    for path, size in sorted(renditions, key=lambda r: r[1][0] * r[1][1], reverse=True):
+        image = image.copy()
+        image.thumbnail(size, reducing_gap=3.0)
+        image.save(path, image_format, **thumbnail_save_options.get(image_format, {}))
+
+def save_placeholders(renditions, image_format, color):
+    from PIL import Image
+    for path, size in renditions:
+        with Image.new('RGB', size, color=color) as img:
+            img.save(path, image_format)
+
+def create_thumbnail(file_path, thumb_path, size=THUMBNAIL_SIZE, renditions=(), image_format='JPEG'):
+    """Write the grid thumbnail plus any extra (path, size) renditions from one decode of file_path."""
+    renditions = [(thumb_path, size)] + list(renditions)
+    try:
+        max_size = max((s for _, s in renditions), key=lambda s: s[0] * s[1])
+        image, decoder = decode_media(file_path, max_size)
+        if image is None:
             # For other formats, use a placeholder
-            with Image.new('RGB', size, color='grey') as img:
-                img.save(thumb_path, 'JPEG')
-    
+            save_placeholders(renditions, image_format, 'grey')
+            return 'placeholder'
+
+        save_renditions(flatten_image(image), renditions, image_format)
+        logging.debug(f"Thumbnail created with {decoder} for {file_path}")
+        return decoder
+
     except Exception as e:
-        print(f"\nError creating thumbnail for {file_path}: {e}")
+        logging.warning(f"Error creating thumbnail for {file_path}, using a red placeholder: {e}")
         # Create a red placeholder thumbnail in case of any error
-        with Image.new('RGB', size, color='red') as img:
-            img.save(thumb_path, 'JPEG')
-        print(f"Red placeholder created for {file_path} due to error")
+        save_placeholders(renditions, image_format, 'red')
+        return 'placeholder'
 
  
 
 def create_thumbnail_wrapper(args):
-    file_path, thumb_path, size = args
-    create_thumbnail(file_path, thumb_path, size)
-    return file_path, thumb_path
-    
-def generate_html_gallery(disc_dir):
-    print(f"\nGenerating HTML gallery for {disc_dir}...")
+    file_path, thumb_path, size, renditions, image_format = args
+    decoder = create_thumbnail(file_path, thumb_path, size, renditions, image_format)
+    return file_path, thumb_path, decoder
     
-    albums = {}
-    thumbnail_tasks = []
+def list_disc_media(disc_dir):
+    """Walk a staged disc directory and return (file path, path relative to the disc) for every file on it."""
+    from tqdm import tqdm
+    media = []
     total_files = sum(len(files) for _, _, files in os.walk(disc_dir))
     
     with tqdm(total=total_files, desc="Processing files", unit="file") as pbar:
         for root, dirs, files in os.walk(disc_dir):
+            if root == disc_dir and GALLERY_ASSET_DIR in dirs:
+                dirs.remove(GALLERY_ASSET_DIR)
+            if root == disc_dir and PARITY_DIR in dirs:
+                dirs.remove(PARITY_DIR)
             if 'thumbs' in dirs:
                 dirs.remove('thumbs')
+            if 'previews' in dirs:
+                dirs.remove('previews')
+            if PROXY_DIR in dirs:
+                dirs.remove(PROXY_DIR)
             if 'exiftool_files' in dirs:
                 dirs.remove('exiftool_files')
             if 'ignore' in dirs:
                 dirs.remove('ignore')
             
             for file in files:
-                if file.endswith('.html'):
-                    pbar.update(1)
-                    continue
-                
-                file_ext = os.path.splitext(file)[1].lower()
-                if file_ext in image_extensions or file_ext in video_extensions or file_ext in raw_video_extensions:
-                    try:
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(file_path, disc_dir)
-                        album_name = os.path.relpath(root, disc_dir).split(os.sep)[0]
-                        
-                        thumb_dir = os.path.join(root, 'thumbs')
-                        os.makedirs(thumb_dir, exist_ok=True)
-                        thumb_path = os.path.join(thumb_dir, f"{os.path.splitext(file)[0]}.jpg")
-                        
-                        thumbnail_tasks.append((file_path, thumb_path, (200, 200)))
-                        
-                        file_type = "image" if file_ext in image_extensions else "video"
-                        if album_name not in albums:
-                            albums[album_name] = []
-                        albums[album_name].append((relative_path.replace(os.sep, "/"), os.path.relpath(thumb_path, disc_dir).replace(os.sep, "/"), file, file_type))
-                    except Exception as e:
-                        print(f" Error processing {file_path}: {e}")
+                if not file.endswith('.html'):
+                    file_path = os.path.join(root, file)
+                    media.append((file_path, os.path.relpath(file_path, disc_dir)))
                 pbar.update(1)
+    return media
+
+def generate_html_gallery(disc_dir, thumbnail_format='JPEG', preview_size=PREVIEW_SIZE, file_metadata=None, media_files=None):
+    """Build the gallery for disc_dir. file_metadata maps paths on the disc to what get_media_info read for
+    them during the metadata pass. media_files lists (file path, path on the disc) for discs whose originals
+    are not staged in disc_dir; renditions and gallery files are written to disc_dir either way."""
+    from tqdm import tqdm
+    print(f"\nGenerating HTML gallery for {disc_dir}...")
     
-    print("Generating thumbnails...")
-    with multiprocessing.Pool(processes=getCPUs()) as pool:
-        list(tqdm(pool.imap_unordered(create_thumbnail_wrapper, thumbnail_tasks), total=len(thumbnail_tasks), desc="Creating thumbnails", unit="thumbnail"))
+    albums = {}
+    thumbnail_tasks = []
+    thumb_ext = thumbnail_extensions[thumbnail_format]
+    if media_files is None:
+        media_files = list_disc_media(disc_dir)
     
-    print("Generating HTML content...")
-    html = generate_html_structure(albums)
+    for file_path, relative_path in media_files:
+        file_ext = os.path.splitext(file_path)[1].lower()
+        if file_ext in rendition_extensions:
+            try:
+                relative_path = relative_path.replace(os.sep, "/")
+                parts = relative_path.split("/")
+                album_name = parts[0] if len(parts) > 1 else "."
+                
+                thumb_path, thumb_2x_path, preview_path = rendition_paths(os.path.join(disc_dir, relative_path), thumb_ext)
+                os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+                
+                renditions = [(thumb_2x_path, THUMBNAIL_2X_SIZE), (preview_path, preview_size)]
+                thumbnail_tasks.append((file_path, thumb_path, THUMBNAIL_SIZE, renditions, thumbnail_format))
+                
+                file_type = "image" if file_ext in image_extensions or file_ext in raw_image_extensions else "video"
+                if file_type == "video" and os.path.exists(os.path.join(disc_dir, proxy_path(relative_path))):
+                    file_type = "proxy"
+                if album_name not in albums:
+                    albums[album_name] = []
+                date_taken, *details = (file_metadata or {}).get(relative_path) or (None, None, None, None, None)
+                albums[album_name].append((relative_path, file_type, date_taken, tuple(details)))
+            except Exception as e:
+                logging.warning(f"Error processing {file_path}: {e}")
+
+    # Each album reads as a timeline: oldest first, undated files at the end
+    for files in albums.values():
+        files.sort(key=lambda item: (item[2] is None, item[2] or datetime.min, item[0]))
+    
+    print("Generating thumbnails...")
+    with run_report.stage('thumbnails'), multiprocessing.Pool(processes=getCPUs(), **pool_initializer('thumbnails')) as pool:
+        for (file_path, _, decoder), seconds, cpu_seconds in tqdm(
+                pool.imap_unordered(partial(timed_task, create_thumbnail_wrapper), thumbnail_tasks),
+                total=len(thumbnail_tasks), desc="Creating thumbnails", unit="thumbnail"):
+            # A source that vanished got a placeholder, and is reported when it is copied or imaged
+            size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            run_report.record('thumbnails', cpu_seconds=cpu_seconds, size=size)
+            # Split by decoder, since rawpy and ffmpeg decodes cost far more than PIL ones
+            run_report.record(f'thumbnails.{decoder}', seconds, cpu_seconds, size=size)
+        pool.close()
+        pool.join()
     
-    print("Writing HTML file...")
-    with open(os.path.join(disc_dir, 'index.html'), 'w', encoding='utf-8') as f:
-        f.write(html)
+    print("Writing media index, search index and HTML file...")
+    with run_report.stage('html'):
+        write_gallery_index(disc_dir, albums, thumb_ext)
+        write_search_index(disc_dir, albums)
+        write_gallery_assets(disc_dir)
     print(f"HTML gallery generated for {disc_dir}")
 
-def generate_html_structure(albums):
-    html = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 100'><rect x='10' y='10' width='80' height='80' rx='10' fill='%234a90e2'/><circle cx='50' cy='50' r='30' fill='%23f5a623'/><path d='M50 20 L80 50 L50 80 L20 50 Z' fill='%23fff'/></svg>" />
-    <title>Media Gallery</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            line-height: 1.6;
-            margin: 0;
-            padding: 20px;
-            background-color: #f4f4f4;
-        }
-        .album {
-            background-color: #fff;
-            border-radius: 5px;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-            margin-bottom: 20px;
-            overflow: hidden;
-        }
-        .album h2 {
-            background-color: #007bff;
-            color: #fff;
-            padding: 10px;
-            margin: 0;
-        }
-        .album-content {
-            padding: 15px;
-        }
-        .thumbnail-container {
-            display: flex;
-            flex-wrap: wrap;
-            gap: 10px;
-        }
-        .thumbnail {
-            width: 150px;
-            height: 150px;
-            object-fit: cover;
-            cursor: pointer;
-            transition: transform 0.3s ease;
-        }
-        .thumbnail:hover {
-            transform: scale(1.05);
-        }
-        .expand-btn {
-            background-color: #28a745;
-            color: #fff;
-            border: none;
-            padding: 5px 10px;
-            cursor: pointer;
-            margin-top: 10px;
-        }
-        .expand-btn:hover {
-            background-color: #218838;
-        }
-        .hidden {
-            display: none !important;
-        }
-        .thumbnail-wrapper {
-            position: relative;
-            display: inline-block;
-        }
-        .file-type-icon {
-            position: absolute;
-            bottom: 5px;
-            right: 5px;
-            background-color: rgba(0, 0, 0, 0.7);
-            color: white;
-            padding: 2px 5px;
-            font-size: 12px;
-            border-radius: 3px;
-        }
-        .modal {
-            display: none;
-            position: fixed;
-            z-index: 1000;
-            left: 0;
-            top: 0;
-            width: 100%;
-            height: 100%;
-            overflow: auto;
-            background-color: rgba(0,0,0,0.9);
-        }
-        .modal-content {
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            height: 100%;
-            padding: 20px;
-            box-sizing: border-box;
-            user-select: none;
-        }
-        .modal-content img {
-            max-width: 90%;
-            max-height: 90vh;
-            object-fit: contain;
-        }
-        .modal-content video {
-            max-width: 90%;
-            max-height: 90vh;
-        }
-        .close {
-            position: absolute;
-            top: 15px;
-            right: 35px;
-            color: #f1f1f1;
-            font-size: 40px;
-            font-weight: bold;
-            transition: 0.3s;
-        }
-        .close:hover,
-        .close:focus {
-            color: #bbb;
-            text-decoration: none;
-            cursor: pointer;
-        }
-        .nav-button {
-            position: absolute;
-            top: 50%;
-            background-color: rgba(0,0,0,0.5);
-            border: none;
-            color: white;
-            font-size: 36px;
-            padding: 10px;
-            cursor: pointer;
-            border-radius: 50%;
-            user-select: none;
-        }
+# Video proxies. With --proxies every video also gets a small H.264/AAC MP4 next to it (proxies/<name>.mp4)
+# that any browser can play smoothly from a disc; the gallery plays it and links to the original. Proxies
+# are transcoded into a cache in the destination under a key of the source's path, size and mtime, so a
+# run that was interrupted, or a later one, only transcodes what is missing.
+PROXY_DIR = 'proxies'
+PROXY_CACHE_DIR = 'proxy_cache'
+PROXY_HEIGHT = 720
+PROXY_VIDEO_BITRATE = 2000000
+PROXY_AUDIO_BITRATE = 128000
+PROXY_TIMEOUT = 1800                 # seconds one transcode may take before it is abandoned
+# Room the packer keeps per second of video, with a margin over the capped bitrates; videos of unknown
+# duration are assumed to need a quarter of their size
+PROXY_BYTES_PER_SECOND = (PROXY_VIDEO_BITRATE + PROXY_AUDIO_BITRATE) // 8 * 11 // 10
+PROXY_UNKNOWN_SHARE = 0.25
 
-        #prevButton {
-            left: 20px;
-        }
+proxy_queue = None
 
-        #nextButton {
-            right: 20px;
-        }
-    </style>
-</head>
-<body>
-    <h1>Media Gallery</h1>
-    """
-    for album_name, files in albums.items():
-        encoded_album_name = urllib.parse.quote(album_name)
-        html += f"""
-    <div class="album">
-        <h2>{album_name}</h2>
-        <div class="album-content">
-            <div class="thumbnail-container">
-        """
-        
-        for i, (file_path, thumb_path, file_name, file_type) in enumerate(files):
-            hidden_class = ' hidden' if i >= 5 else ''
-            file_ext = os.path.splitext(file_name)[1].lower()
-            icon_text = 'Video' if file_ext in video_extensions or file_ext in raw_video_extensions else file_ext[1:].upper()
-            
-            encoded_file_path = urllib.parse.quote(file_path)
-            encoded_thumb_path = urllib.parse.quote(thumb_path)
-            encoded_file_name = urllib.parse.quote(file_name)
-            
-            html += f"""
-                <div class="thumbnail-wrapper{hidden_class}">
-                    <a href="{encoded_file_path}" class="thumbnail-link" data-type="{file_type}">
-                        <img class="thumbnail" data-src="{encoded_thumb_path}" alt="{encoded_file_name}" title="{file_type}: {encoded_file_name}">
-                        <span class="file-type-icon">{icon_text}</span>
-                    </a>
-                </div>
-            """
-        
-        html += """
-            </div>
-        """
-        
-        if len(files) > 5:
-            html += """
-            <button class="expand-btn">Show More</button>
-            """
-        
-        html += """
-        </div>
-    </div>
-        """
+def proxy_path(relative_path):
+    directory, file_name = os.path.split(relative_path)
+    return os.path.join(directory, PROXY_DIR, os.path.splitext(file_name)[0] + '.mp4')
 
-    html += """
-    <div id="mediaModal" class="modal">
-        <span class="close">&times;</span>
-        <div class="modal-content">
-            <button class="nav-button" id="prevButton">&#10094;</button>
-            <img id="modalImage" src="" style="display:none;">
-            <video id="modalVideo" controls style="display:none;">
-                <source id="modalVideoSource" src="" type="">
-                Your browser does not support the video tag.
-            </video>
-            <div id="modalMessage" style="display:none; color: white; text-align: center;">
-                This video format is not supported by your browser.
-                <a id="modalDownloadLink" href="" style="color: #0af;">Click here to download the video.</a>
-            </div>
-            <button class="nav-button" id="nextButton">&#10095;</button>
-        </div>
-    </div>
-    <script>
-        var mediaItems = [];
-        var currentIndex = -1;
-        // Lazy loading
-        document.addEventListener("DOMContentLoaded", function() {
-            var lazyImages = [].slice.call(document.querySelectorAll("img.thumbnail"));
-
-            if ("IntersectionObserver" in window) {
-                let lazyImageObserver = new IntersectionObserver(function(entries, observer) {
-                    entries.forEach(function(entry) {
-                        if (entry.isIntersecting) {
-                            let lazyImage = entry.target;
-                            lazyImage.src = lazyImage.dataset.src;
-                            lazyImage.classList.remove("lazy");
-                            lazyImageObserver.unobserve(lazyImage);
-                        }
-                    });
-                });
-
-                lazyImages.forEach(function(lazyImage) {
-                    lazyImageObserver.observe(lazyImage);
-                });
-            } else {
-                // Fallback for browsers that don't support IntersectionObserver
-                let active = false;
-
-                const lazyLoad = function() {
-                    if (active === false) {
-                        active = true;
-
-                        setTimeout(function() {
-                            lazyImages.forEach(function(lazyImage) {
-                                if ((lazyImage.getBoundingClientRect().top <= window.innerHeight && lazyImage.getBoundingClientRect().bottom >= 0) && getComputedStyle(lazyImage).display !== "none") {
-                                    lazyImage.src = lazyImage.dataset.src;
-                                    lazyImage.classList.remove("lazy");
-
-                                    lazyImages = lazyImages.filter(function(image) {
-                                        return image !== lazyImage;
-                                    });
-
-                                    if (lazyImages.length === 0) {
-                                        document.removeEventListener("scroll", lazyLoad);
-                                        window.removeEventListener("resize", lazyLoad);
-                                        window.removeEventListener("orientationchange", lazyLoad);
-                                    }
-                                }
-                            });
-
-                            active = false;
-                        }, 200);
-                    }
-                };
-
-                document.addEventListener("scroll", lazyLoad);
-                window.addEventListener("resize", lazyLoad);
-                window.addEventListener("orientationchange", lazyLoad);
-            }
-            
-            var thumbnails = document.querySelectorAll(".thumbnail-link");
-            thumbnails.forEach(function(thumb, index) {
-                mediaItems.push({
-                    src: thumb.getAttribute('href'),
-                    type: thumb.getAttribute('data-type'),
-                    fileExt: thumb.getAttribute('href').split('.').pop().toLowerCase()
-                });
-                // Store index as a data attribute for easy access
-                thumb.dataset.index = index;
-            });
-            
-            var expandButtons = document.querySelectorAll(".expand-btn");
-            expandButtons.forEach(function(button) {
-                button.addEventListener("click", function() {
-                    var album = this.closest(".album");
-                    var hiddenThumbnails = album.querySelectorAll(".thumbnail-wrapper.hidden");
-                    hiddenThumbnails.forEach(function(thumbnail) {
-                        thumbnail.classList.remove("hidden");
-                    });
-                    this.style.display = "none";
-                });
-            });
-        });
-		// Modal functionality
-        var modal = document.getElementById('mediaModal');
-        var modalImg = document.getElementById("modalImage");
-        var modalVideo = document.getElementById("modalVideo");
-        var modalVideoSource = document.getElementById("modalVideoSource");
-        var modalMessage = document.getElementById('modalMessage');
-        var downloadLink = document.getElementById('modalDownloadLink');
-        var closeBtn = document.getElementsByClassName("close")[0];
-        var prevButton = document.getElementById('prevButton');
-        var nextButton = document.getElementById('nextButton');
-
-        function showMedia(index) {
-            if (index < 0 || index >= mediaItems.length) {
-                return;
-            }
-            currentIndex = index;
-            var item = mediaItems[index];
-            var src = item.src;
-            var type = item.type;
-            var fileExt = item.fileExt;
-            var mimeType = '';
-
-            if (type === "image") {
-                modalImg.src = src;
-                modalImg.style.display = "block";
-                modalVideo.style.display = "none";
-                modalMessage.style.display = "none";
-            } else if (type === "video") {
-                // Determine MIME type based on file extension
-                if (fileExt === 'mp4') {
-                    mimeType = 'video/mp4';
-                } else if (fileExt === 'webm') {
-                    mimeType = 'video/webm';
-                } else if (fileExt === 'ogg' || fileExt === 'ogv') {
-                    mimeType = 'video/ogg';
-                } else {
-                    mimeType = '';
-                }
-
-                modalVideoSource.src = src;
-                modalVideoSource.type = mimeType;
-                modalVideo.load();
-
-                if (mimeType) {
-                    modalVideo.style.display = "block";
-                    modalImg.style.display = "none";
-                    modalMessage.style.display = "none";
-                } else {
-                    // Unsupported video format
-                    modalVideo.style.display = "none";
-                    modalImg.style.display = "none";
-                    modalMessage.style.display = "block";
-                    downloadLink.href = src;
-                }
-            }
-            modal.style.display = "block";
-        }
+def is_video(file_path):
+    file_ext = os.path.splitext(file_path)[1].lower()
+    return file_ext in video_extensions or file_ext in raw_video_extensions
 
-        // Click event for thumbnails
-        document.addEventListener('click', function(e) {
-            if (e.target && e.target.classList.contains('thumbnail')) {
-                var link = e.target.closest('.thumbnail-link');
-                var index = parseInt(link.dataset.index);
-                showMedia(index);
-                e.preventDefault();
-                return false;
-            } else if (e.target && e.target.classList.contains('modal-content')) {
-				modal.style.display = "none";
-				modalVideo.pause();
-				modalVideo.style.display = "none";
-				modalImg.style.display = "none";
-				modalMessage.style.display = "none";
-			}
-        });
+def proxy_reserve(inventory):
+    """Bytes to set aside on a disc for the proxy of each file of inventory, 0 for everything but videos."""
+    import numpy as np
+    reserve = np.zeros(len(inventory), dtype=np.int64)
+    durations = inventory.column('duration')
+    sizes = inventory.column('size')
+    for row in range(len(inventory)):
+        if is_video(inventory.name(row)):
+            if math.isnan(durations[row]):
+                reserve[row] = sizes[row] * PROXY_UNKNOWN_SHARE
+            else:
+                reserve[row] = min(sizes[row], durations[row] * PROXY_BYTES_PER_SECOND)
+    return reserve
 
-        // Next and Previous button functionality
-        nextButton.onclick = function() {
-            if (currentIndex + 1 < mediaItems.length) {
-                showMedia(currentIndex + 1);
-            }
-        };
+class ProxyQueue:
+    """Runs proxy transcodes, at most max_jobs at a time, each stopped after timeout seconds."""
+    def __init__(self, cache_dir, max_jobs=2, timeout=PROXY_TIMEOUT, height=PROXY_HEIGHT):
+        self.cache_dir = cache_dir
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.height = height
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in os.listdir(cache_dir):
+            if stale.endswith('.part'):
+                # Left over from an interrupted run
+                os.remove(os.path.join(cache_dir, stale))
 
-        prevButton.onclick = function() {
-            if (currentIndex - 1 >= 0) {
-                showMedia(currentIndex - 1);
-            }
-        };
+    def cache_path(self, source_key, size, mtime):
+        key = hashlib.sha1(f"{source_key}|{size}|{mtime}|{self.height}|{PROXY_VIDEO_BITRATE}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.mp4')
 
-        // Close button functionality
-        closeBtn.onclick = function() {
-            modal.style.display = "none";
-            modalVideo.pause();
-            modalVideo.style.display = "none";
-            modalImg.style.display = "none";
-            modalMessage.style.display = "none";
-        };
+    def transcode(self, source_path, cache_path):
+        part_path = cache_path + '.part'
+        command = ['ffmpeg', '-v', 'error', '-y', '-i', source_path, '-map', '0:v:0', '-map', '0:a:0?',
+                   '-vf', f"scale=-2:'min({self.height},ih)'", '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '26',
+                   '-maxrate', str(PROXY_VIDEO_BITRATE), '-bufsize', str(2 * PROXY_VIDEO_BITRATE), '-pix_fmt', 'yuv420p',
+                   '-c:a', 'aac', '-b:a', str(PROXY_AUDIO_BITRATE), '-ac', '2', '-movflags', '+faststart', '-f', 'mp4', part_path]
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout)
+            if result.returncode != 0:
+                raise Exception(f"FFmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+            os.replace(part_path, cache_path)
+        except subprocess.TimeoutExpired:
+            raise Exception(f"Transcoding took longer than {self.timeout} seconds")
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
 
-        window.onclick = function(event) {
-            if (event.target == modal) {
-                modal.style.display = "none";
-                modalVideo.pause();
-                modalVideo.style.display = "none";
-                modalImg.style.display = "none";
-                modalMessage.style.display = "none";
-            } 
-        };
+    def run(self, jobs):
+        """Transcode (source path, cache path) jobs whose proxy is not cached yet. Returns the set of cache
+        paths that are available afterwards."""
+        from concurrent.futures import ThreadPoolExecutor
+        from tqdm import tqdm
+        done = {cache_path for _, cache_path in jobs if os.path.exists(cache_path)}
+        todo = [(source_path, cache_path) for source_path, cache_path in jobs if cache_path not in done]
+        if done:
+            logging.info(f"{len(done)} video proxies are already in the cache")
+        if not todo:
+            return done
 
-        // Keyboard navigation
-        document.addEventListener('keydown', function(e) {
-            if (modal.style.display === "block") {
-                if (e.key === 'ArrowRight' || e.key === 'Right') {
-                    nextButton.onclick();
-                } else if (e.key === 'ArrowLeft' || e.key === 'Left') {
-                    prevButton.onclick();
-                } else if (e.key === 'Escape' || e.key === 'Esc') {
-                    closeBtn.onclick();
-                }
-            }
-        });
-    </script>
-</body>
-</html>
-    """
-    
-    return html
+        def job(source_path, cache_path):
+            start = time.perf_counter()
+            try:
+                self.transcode(source_path, cache_path)
+                return cache_path, time.perf_counter() - start, None
+            except Exception as e:
+                return cache_path, time.perf_counter() - start, f"{source_path}: {e}"
 
+        # The work happens in the ffmpeg processes, so threads are enough to keep max_jobs of them running
+        with run_report.stage('proxies'), ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            futures = [executor.submit(job, *task) for task in todo]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Transcoding video proxies", unit="video"):
+                cache_path, seconds, error = future.result()
+                if error:
+                    logging.warning(f"No proxy for {error}")
+                    continue
+                run_report.record('proxies', seconds, size=os.path.getsize(cache_path))
+                done.add(cache_path)
+        return done
 
+def write_disc_proxies(disc_dir, disc, inventory):
+    """Transcode (or take from the cache) the proxies for the videos among disc's rows, placing them in
+    disc_dir at the path the gallery expects. Returns the number of proxies placed."""
+    jobs = []
+    for row in disc:
+        if is_video(inventory.name(row)):
+            cache_path = proxy_queue.cache_path(inventory.catalog_path(row), inventory.size[row], inventory.mtime[row])
+            # The staged copy when there is one, since --move has taken the original away by now
+            source_path = os.path.join(disc_dir, inventory.disc_path(row))
+            if not os.path.exists(source_path):
+                source_path = os.path.join(inventory.source_dir, inventory.source_path(row))
+            jobs.append((row, source_path, cache_path))
+    if not jobs:
+        return 0
+    available = proxy_queue.run([(source_path, cache_path) for _, source_path, cache_path in jobs])
+    placed = 0
+    for row, _, cache_path in jobs:
+        if cache_path not in available:
+            continue
+        target = os.path.join(disc_dir, proxy_path(inventory.disc_path(row)))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(cache_path, target)
+        except OSError:
+            shutil.copyfile(cache_path, target)
+        placed += 1
+    return placed
 
-def process_file(args):
-    global source_dir_global, dest_dir_global, move_files_global, file_hashes, log_lock
-    file_info, current_disc_dir, log_file = args
-    source_album_name, dest_album_name, file_path, file_size = file_info
-    
-    try:
-        # Construct the source path
-        source_path = os.path.join(source_dir_global, source_album_name, file_path)
-        
-        # Construct the destination path, using the new album name (which might include disc number)
-        dest_path = os.path.join(current_disc_dir, dest_album_name, file_path)
-        
-        logging.debug(f"Processing file: {source_path} -> {dest_path}")
+# Static gallery assets, written once per disc next to index.html so the browser can cache them
+GALLERY_ASSET_DIR = '_gallery'
 
-        if not os.path.exists(source_path):
-            logging.error(f"Source file does not exist: {source_path}")
-            return None, 0, None, f"Source file does not exist: {source_path}"
+# Items per media index chunk; an album larger than this is split over several chunk files
+GALLERY_CHUNK_SIZE = 2000
 
-        if not os.access(source_path, os.R_OK):
-            logging.error(f"No read permission for source file: {source_path}")
-            return None, 0, None, f"No read permission for source file: {source_path}"
+GALLERY_CSS = """body {
+    font-family: Arial, sans-serif;
+    line-height: 1.6;
+    margin: 0;
+    padding: 20px;
+    background-color: #f4f4f4;
+}
+.toolbar {
+    display: flex;
+    flex-wrap: wrap;
+    align-items: center;
+    gap: 10px;
+    margin-bottom: 20px;
+}
+.toolbar input[type="search"] {
+    flex: 1;
+    min-width: 200px;
+    padding: 5px 10px;
+    font-size: 16px;
+}
+#searchStatus,
+#catalogStatus {
+    color: #555;
+}
+.catalog-table {
+    border-collapse: collapse;
+    width: 100%;
+    background-color: #fff;
+    margin-bottom: 20px;
+}
+.catalog-table th,
+.catalog-table td {
+    border: 1px solid #ddd;
+    padding: 5px 10px;
+    text-align: left;
+    word-break: break-all;
+}
+#gallery {
+    position: relative;
+}
+.gallery-header {
+    position: absolute;
+    left: 0;
+    right: 0;
+    height: 46px;
+    box-sizing: border-box;
+    background-color: #007bff;
+    color: #fff;
+    padding: 10px;
+    margin: 0;
+    font-size: 20px;
+    line-height: 26px;
+    border-radius: 5px;
+    overflow: hidden;
+    white-space: nowrap;
+    text-overflow: ellipsis;
+}
+.gallery-header .count {
+    font-size: 14px;
+    opacity: 0.8;
+    margin-left: 10px;
+}
+.gallery-row {
+    position: absolute;
+    left: 0;
+    right: 0;
+    height: 150px;
+    display: flex;
+    gap: 10px;
+}
+.thumbnail {
+    width: 150px;
+    height: 150px;
+    object-fit: cover;
+    cursor: pointer;
+    transition: transform 0.3s ease;
+}
+.thumbnail:hover {
+    transform: scale(1.05);
+}
+.thumbnail-wrapper {
+    position: relative;
+    display: inline-block;
+    width: 150px;
+    height: 150px;
+    background-color: #ddd;
+}
+.file-type-icon {
+    position: absolute;
+    bottom: 5px;
+    right: 5px;
+    background-color: rgba(0, 0, 0, 0.7);
+    color: white;
+    padding: 2px 5px;
+    font-size: 12px;
+    border-radius: 3px;
+}
+.modal {
+    display: none;
+    position: fixed;
+    z-index: 1000;
+    left: 0;
+    top: 0;
+    width: 100%;
+    height: 100%;
+    overflow: auto;
+    background-color: rgba(0,0,0,0.9);
+}
+.modal-content {
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    height: 100%;
+    padding: 20px;
+    box-sizing: border-box;
+    user-select: none;
+}
+.modal-content img {
+    max-width: 90%;
+    max-height: 90vh;
+    object-fit: contain;
+}
+.modal-content video {
+    max-width: 90%;
+    max-height: 90vh;
+}
+.close {
+    position: absolute;
+    top: 15px;
+    right: 35px;
+    color: #f1f1f1;
+    font-size: 40px;
+    font-weight: bold;
+    transition: 0.3s;
+}
+.close:hover,
+.close:focus {
+    color: #bbb;
+    text-decoration: none;
+    cursor: pointer;
+}
+.nav-button {
+    position: absolute;
+    top: 50%;
+    background-color: rgba(0,0,0,0.5);
+    border: none;
+    color: white;
+    font-size: 36px;
+    padding: 10px;
+    cursor: pointer;
+    border-radius: 50%;
+    user-select: none;
+}
+
+#prevButton {
+    left: 20px;
+}
+
+#nextButton {
+    right: 20px;
+}
+
+.original-link {
+    position: absolute;
+    bottom: 15px;
+    right: 35px;
+    color: #0af;
+}
+
+.modal-info {
+    position: absolute;
+    bottom: 15px;
+    left: 35px;
+    right: 160px;
+    color: #ccc;
+    font-size: 14px;
+    overflow: hidden;
+    white-space: nowrap;
+    text-overflow: ellipsis;
+}
+"""
+
+GALLERY_JS = """// The page only knows the album list from _gallery/index.js. Item data is loaded per album
+// chunk as it scrolls into view, and only the rows near the viewport are kept in the DOM.
+var galleryIndex = null;
+var loadedChunks = {};
+var chunkCallbacks = {};
+var sections = [];
+var sectionLayout = [];
+var renderedRows = {};
+var columns = 1;
+var viewLength = 0;
+var currentIndex = -1;
+var renderQueued = false;
+var galleryEl = null;
+
+var CELL_SIZE = 160;
+var HEADER_HEIGHT = 56;
+var SECTION_GAP = 20;
+var OVERSCAN = 800;
+
+function galleryLoadIndex(data) {
+    galleryIndex = data;
+}
+
+function galleryLoadChunk(albumIndex, chunkIndex, items) {
+    var key = albumIndex + ':' + chunkIndex;
+    loadedChunks[key] = items;
+    var callbacks = chunkCallbacks[key] || [];
+    delete chunkCallbacks[key];
+    callbacks.forEach(function(callback) {
+        callback();
+    });
+}
+
+function pad(number, width) {
+    var text = String(number);
+    while (text.length < width) {
+        text = '0' + text;
+    }
+    return text;
+}
+
+function encodePath(path) {
+    return path.split('/').map(encodeURIComponent).join('/');
+}
+
+// Returns the largest i with values[i] <= target, for any ascending array-like accessor
+function searchStart(length, valueAt, target) {
+    var lo = 0;
+    var hi = length - 1;
+    while (lo < hi) {
+        var mid = (lo + hi + 1) >> 1;
+        if (valueAt(mid) <= target) {
+            lo = mid;
+        } else {
+            hi = mid - 1;
+        }
+    }
+    return lo;
+}
+
+function locateItem(index) {
+    var albums = galleryIndex.albums;
+    var albumIndex = searchStart(albums.length, function(i) { return albums[i].start; }, index);
+    var offset = index - albums[albumIndex].start;
+    return {
+        album: albumIndex,
+        chunk: Math.floor(offset / galleryIndex.chunkSize),
+        offset: offset % galleryIndex.chunkSize
+    };
+}
+
+function loadChunk(albumIndex, chunkIndex, callback) {
+    var key = albumIndex + ':' + chunkIndex;
+    if (loadedChunks[key]) {
+        callback();
+        return;
+    }
+    if (chunkCallbacks[key]) {
+        chunkCallbacks[key].push(callback);
+        return;
+    }
+    chunkCallbacks[key] = [callback];
+    var script = document.createElement('script');
+    script.src = galleryIndex.dataDir + '/a' + pad(albumIndex, 5) + '_' + pad(chunkIndex, 3) + '.js';
+    document.head.appendChild(script);
+}
+
+// Mirrors rendition_paths() and proxy_path() in process.py
+function renditionPaths(path) {
+    var slash = path.lastIndexOf('/');
+    var dir = path.slice(0, slash + 1);
+    var name = path.slice(slash + 1);
+    var dot = name.lastIndexOf('.');
+    var stem = dot > 0 ? name.slice(0, dot) : name;
+    var ext = galleryIndex.thumbExt;
+    return {
+        thumb: dir + 'thumbs/' + stem + ext,
+        thumb2x: dir + 'thumbs/' + stem + '@2x' + ext,
+        preview: dir + 'previews/' + stem + ext,
+        proxy: dir + 'proxies/' + stem + '.mp4'
+    };
+}
+
+function getItem(index) {
+    var location = locateItem(index);
+    var items = loadedChunks[location.album + ':' + location.chunk];
+    if (!items) {
+        return null;
+    }
+    // [path, type, date, width, height, duration, camera], see gallery_entry() in process.py
+    var entry = items[location.offset];
+    var path = entry[0];
+    var name = path.slice(path.lastIndexOf('/') + 1);
+    var paths = renditionPaths(path);
+    return {
+        src: encodePath(path),
+        name: name,
+        type: entry[1] === 'i' ? 'image' : 'video',
+        proxy: entry[1] === 'p' ? encodePath(paths.proxy) : null,
+        fileExt: name.split('.').pop().toLowerCase(),
+        thumb: encodePath(paths.thumb),
+        thumb2x: encodePath(paths.thumb2x),
+        preview: encodePath(paths.preview),
+        date: entry[2] || null,
+        width: entry[3] || null,
+        height: entry[4] || null,
+        duration: entry[5] == null ? null : entry[5],
+        camera: entry[6] || null
+    };
+}
+
+function formatDuration(seconds) {
+    seconds = Math.round(seconds);
+    var hours = Math.floor(seconds / 3600);
+    var minutes = Math.floor(seconds / 60) % 60;
+    return (hours ? hours + ':' + pad(minutes, 2) : minutes) + ':' + pad(seconds % 60, 2);
+}
+
+function describeItem(item) {
+    var parts = [item.name];
+    if (item.date) {
+        parts.push(item.date);
+    }
+    if (item.width && item.height) {
+        parts.push(item.width + ' \\u00d7 ' + item.height);
+    }
+    if (item.duration !== null) {
+        parts.push(formatDuration(item.duration));
+    }
+    if (item.camera) {
+        parts.push(item.camera);
+    }
+    return parts.join(' \\u00b7 ');
+}
+
+function withItem(index, callback) {
+    var location = locateItem(index);
+    loadChunk(location.album, location.chunk, function() {
+        callback(getItem(index));
+    });
+}
+
+// A section is a titled run of items; itemAt maps a position within the section to an item index
+function albumSections() {
+    return galleryIndex.albums.map(function(album) {
+        return {
+            title: album.name,
+            count: album.count,
+            itemAt: function(i) { return album.start + i; }
+        };
+    });
+}
+
+var MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+                   'October', 'November', 'December'];
+
+// month is 'YYYY-MM', or null for undated items
+function monthTitle(month) {
+    if (!month) {
+        return 'Undated';
+    }
+    return MONTH_NAMES[parseInt(month.slice(5), 10) - 1] + ' ' + month.slice(0, 4);
+}
+
+// Album items are sorted by date, so each month of an album is a contiguous run listed in album.months
+function albumMonthSections() {
+    var result = [];
+    galleryIndex.albums.forEach(function(album) {
+        var start = album.start;
+        album.months.forEach(function(run) {
+            var first = start;
+            result.push({
+                title: album.name + ' \\u00b7 ' + monthTitle(run[0]),
+                count: run[1],
+                itemAt: function(i) { return first + i; }
+            });
+            start += run[1];
+        });
+    });
+    return result;
+}
+
+function dayMonth(day) {
+    var date = new Date(day * 86400000);
+    return date.getUTCFullYear() + '-' + pad(date.getUTCMonth() + 1, 2);
+}
+
+// One section per month across the whole disc, from the date-ordered ids in the search index
+function timelineSections() {
+    var days = searchIndex.days;
+    var byDate = searchIndex.byDate;
+    var result = [];
+    var i = 0;
+    while (i < byDate.length) {
+        var month = dayMonth(days[byDate[i]]);
+        var first = i;
+        while (i < byDate.length && dayMonth(days[byDate[i]]) === month) {
+            i++;
+        }
+        result.push({
+            title: monthTitle(month),
+            count: i - first,
+            itemAt: (function(first) {
+                return function(j) { return byDate[first + j]; };
+            })(first)
+        });
+    }
+    var undated = [];
+    for (var id = 0; id < days.length; id++) {
+        if (days[id] === null) {
+            undated.push(id);
+        }
+    }
+    if (undated.length) {
+        result.push({title: monthTitle(null), count: undated.length, itemAt: function(j) { return undated[j]; }});
+    }
+    return result;
+}
+
+function setSections(newSections) {
+    sections = newSections;
+    computeLayout();
+    clearRows();
+    render();
+}
+
+function computeLayout() {
+    columns = Math.max(1, Math.floor((galleryEl.clientWidth + 10) / CELL_SIZE));
+    var top = 0;
+    var first = 0;
+    sectionLayout = sections.map(function(section) {
+        var rows = Math.ceil(section.count / columns);
+        var layout = {top: top, rowsTop: top + HEADER_HEIGHT, rows: rows, first: first};
+        top += HEADER_HEIGHT + rows * CELL_SIZE + SECTION_GAP;
+        first += section.count;
+        return layout;
+    });
+    viewLength = first;
+    galleryEl.style.height = top + 'px';
+}
+
+function clearRows() {
+    galleryEl.innerHTML = '';
+    renderedRows = {};
+}
+
+function viewItemAt(position) {
+    var s = searchStart(sectionLayout.length, function(i) { return sectionLayout[i].first; }, position);
+    return sections[s].itemAt(position - sectionLayout[s].first);
+}
+
+function fillCell(cell, item, position) {
+    cell.innerHTML = '';
+    var link = document.createElement('a');
+    link.href = item.src;
+    link.className = 'thumbnail-link';
+    link.dataset.position = position;
+    var img = document.createElement('img');
+    img.className = 'thumbnail';
+    img.sizes = '150px';
+    img.srcset = item.thumb + ' ' + galleryIndex.thumbWidths[0] + 'w, ' + item.thumb2x + ' ' + galleryIndex.thumbWidths[1] + 'w';
+    img.src = item.thumb;
+    img.alt = item.name;
+    img.title = describeItem(item);
+    var icon = document.createElement('span');
+    icon.className = 'file-type-icon';
+    if (item.type === 'video') {
+        icon.textContent = item.duration !== null ? 'Video ' + formatDuration(item.duration) : 'Video';
+    } else {
+        icon.textContent = item.fileExt.toUpperCase();
+    }
+    link.appendChild(img);
+    link.appendChild(icon);
+    cell.appendChild(link);
+}
+
+function createRow(s, r) {
+    var section = sections[s];
+    var layout = sectionLayout[s];
+    var row = document.createElement('div');
+    row.className = 'gallery-row';
+    row.style.top = (layout.rowsTop + r * CELL_SIZE) + 'px';
+    var end = Math.min(section.count, (r + 1) * columns);
+    for (var i = r * columns; i < end; i++) {
+        var cell = document.createElement('div');
+        cell.className = 'thumbnail-wrapper';
+        row.appendChild(cell);
+        (function(cell, index, position) {
+            withItem(index, function(item) {
+                fillCell(cell, item, position);
+            });
+        })(cell, section.itemAt(i), layout.first + i);
+    }
+    return row;
+}
+
+function createHeader(s) {
+    var header = document.createElement('h2');
+    header.className = 'gallery-header';
+    header.style.top = sectionLayout[s].top + 'px';
+    header.textContent = sections[s].title;
+    var count = document.createElement('span');
+    count.className = 'count';
+    count.textContent = sections[s].count + ' items';
+    header.appendChild(count);
+    return header;
+}
+
+function render() {
+    if (!sections.length) {
+        return;
+    }
+    var galleryTop = galleryEl.getBoundingClientRect().top;
+    var viewTop = -galleryTop - OVERSCAN;
+    var viewBottom = -galleryTop + window.innerHeight + OVERSCAN;
+    var wanted = {};
+
+    var s = searchStart(sectionLayout.length, function(i) { return sectionLayout[i].top; }, viewTop);
+    for (; s < sections.length && sectionLayout[s].top < viewBottom; s++) {
+        var layout = sectionLayout[s];
+        wanted['h' + s] = [s];
+        var firstRow = Math.max(0, Math.floor((viewTop - layout.rowsTop) / CELL_SIZE));
+        var lastRow = Math.min(layout.rows - 1, Math.floor((viewBottom - layout.rowsTop) / CELL_SIZE));
+        for (var r = firstRow; r <= lastRow; r++) {
+            wanted[s + ':' + r] = [s, r];
+        }
+    }
+
+    Object.keys(renderedRows).forEach(function(key) {
+        if (!wanted[key]) {
+            galleryEl.removeChild(renderedRows[key]);
+            delete renderedRows[key];
+        }
+    });
+    Object.keys(wanted).forEach(function(key) {
+        if (!renderedRows[key]) {
+            var args = wanted[key];
+            var element = args.length === 1 ? createHeader(args[0]) : createRow(args[0], args[1]);
+            galleryEl.appendChild(element);
+            renderedRows[key] = element;
+        }
+    });
+}
+
+function scheduleRender() {
+    if (!renderQueued) {
+        renderQueued = true;
+        window.requestAnimationFrame(function() {
+            renderQueued = false;
+            render();
+        });
+    }
+}
+
+// Search and date filtering use the precomputed index in _gallery/search.js, loaded on first use
+var searchIndex = null;
+var searchLoading = false;
+var searchTimer = null;
+var decodedPostings = {};
+
+function gallerySearchIndex(data) {
+    searchIndex = data;
+    runSearch();
+}
+
+function loadSearchIndex() {
+    if (searchIndex || searchLoading) {
+        return;
+    }
+    searchLoading = true;
+    var script = document.createElement('script');
+    script.src = galleryIndex.searchFile;
+    document.head.appendChild(script);
+}
+
+// Must split the same way as search_tokens() in process.py
+function tokenize(text) {
+    return text.toLowerCase().split(/[^\\p{L}\\p{N}]+/u).filter(function(token) {
+        return token.length > 0;
+    });
+}
+
+function decodePostings(text) {
+    var ids = [];
+    var previous = 0;
+    text.split(',').forEach(function(part) {
+        previous += parseInt(part, 36);
+        ids.push(previous);
+    });
+    return ids;
+}
+
+function cachedPostings(kind, tokenIndex) {
+    var key = kind + tokenIndex;
+    if (!decodedPostings[key]) {
+        var source = kind === 'a' ? searchIndex.albumPostings : searchIndex.postings;
+        decodedPostings[key] = decodePostings(source[tokenIndex]);
+    }
+    return decodedPostings[key];
+}
+
+// Index of the first entry in a sorted array that is >= value
+function lowerBound(length, valueAt, value) {
+    var lo = 0;
+    var hi = length;
+    while (lo < hi) {
+        var mid = (lo + hi) >> 1;
+        if (valueAt(mid) < value) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// All tokens starting with prefix form one contiguous run of the sorted token table
+function prefixRange(tokens, prefix) {
+    var at = function(i) { return tokens[i]; };
+    return [lowerBound(tokens.length, at, prefix), lowerBound(tokens.length, at, prefix + '\\uffff')];
+}
+
+function sortedUnique(ids) {
+    ids.sort(function(a, b) { return a - b; });
+    return ids.filter(function(id, i) {
+        return i === 0 || ids[i - 1] !== id;
+    });
+}
+
+function termMatches(term) {
+    var ids = [];
+    var range = prefixRange(searchIndex.tokens, term);
+    for (var t = range[0]; t < range[1]; t++) {
+        ids = ids.concat(cachedPostings('i', t));
+    }
+    range = prefixRange(searchIndex.albumTokens, term);
+    for (t = range[0]; t < range[1]; t++) {
+        cachedPostings('a', t).forEach(function(albumIndex) {
+            var album = galleryIndex.albums[albumIndex];
+            for (var i = 0; i < album.count; i++) {
+                ids.push(album.start + i);
+            }
+        });
+    }
+    return sortedUnique(ids);
+}
+
+function intersect(a, b) {
+    var result = [];
+    var i = 0;
+    var j = 0;
+    while (i < a.length && j < b.length) {
+        if (a[i] < b[j]) {
+            i++;
+        } else if (a[i] > b[j]) {
+            j++;
+        } else {
+            result.push(a[i]);
+            i++;
+            j++;
+        }
+    }
+    return result;
+}
+
+function parseDay(value) {
+    if (!value) {
+        return null;
+    }
+    var time = Date.parse(value + 'T00:00:00Z');
+    return isNaN(time) ? null : Math.floor(time / 86400000);
+}
+
+function runSearch() {
+    var searchInput = document.getElementById('searchInput');
+    var searchStatus = document.getElementById('searchStatus');
+    var terms = tokenize(searchInput.value);
+    var from = parseDay(document.getElementById('dateFrom').value);
+    var to = parseDay(document.getElementById('dateTo').value);
+
+    var view = document.getElementById('viewMode').value;
+    if (!terms.length && from === null && to === null && view !== 'timeline') {
+        searchStatus.textContent = '';
+        setSections(view === 'months' ? albumMonthSections() : albumSections());
+        return;
+    }
+    if (!searchIndex) {
+        searchStatus.textContent = 'Loading search index...';
+        loadSearchIndex();
+        return;
+    }
+    if (!terms.length && from === null && to === null) {
+        searchStatus.textContent = '';
+        setSections(timelineSections());
+        return;
+    }
+
+    var days = searchIndex.days;
+    var results = null;
+    terms.forEach(function(term) {
+        var matches = termMatches(term);
+        results = results === null ? matches : intersect(results, matches);
+    });
+    if (from !== null || to !== null) {
+        var low = from === null ? -Infinity : from;
+        var high = to === null ? Infinity : to;
+        if (results === null) {
+            // Date range only: slice the date-ordered ids with two binary searches
+            var byDate = searchIndex.byDate;
+            var dayAt = function(i) { return days[byDate[i]]; };
+            results = byDate.slice(lowerBound(byDate.length, dayAt, low), lowerBound(byDate.length, dayAt, high + 1));
+        } else {
+            results = results.filter(function(id) {
+                return days[id] !== null && days[id] >= low && days[id] <= high;
+            });
+        }
+    }
+
+    searchStatus.textContent = results.length + (results.length === 1 ? ' match' : ' matches');
+    setSections([{
+        title: 'Search results',
+        count: results.length,
+        itemAt: function(i) { return results[i]; }
+    }]);
+    window.scrollTo(0, 0);
+}
+
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(runSearch, 150);
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    galleryEl = document.getElementById('gallery');
+    if (!galleryIndex) {
+        galleryEl.textContent = 'The media index (_gallery/index.js) could not be loaded.';
+        return;
+    }
+    setSections(albumSections());
+    document.getElementById('searchInput').addEventListener('input', scheduleSearch);
+    document.getElementById('searchInput').addEventListener('focus', loadSearchIndex);
+    document.getElementById('dateFrom').addEventListener('change', runSearch);
+    document.getElementById('dateTo').addEventListener('change', runSearch);
+    document.getElementById('viewMode').addEventListener('change', function() {
+        runSearch();
+        window.scrollTo(0, 0);
+    });
+    window.addEventListener('scroll', scheduleRender);
+    window.addEventListener('resize', function() {
+        var previousColumns = columns;
+        computeLayout();
+        if (columns !== previousColumns) {
+            clearRows();
+        }
+        scheduleRender();
+    });
+});
+
+// Modal functionality
+var modal = document.getElementById('mediaModal');
+var modalImg = document.getElementById("modalImage");
+var modalVideo = document.getElementById("modalVideo");
+var modalVideoSource = document.getElementById("modalVideoSource");
+var modalMessage = document.getElementById('modalMessage');
+var downloadLink = document.getElementById('modalDownloadLink');
+var originalLink = document.getElementById('modalOriginalLink');
+var modalInfo = document.getElementById('modalInfo');
+var closeBtn = document.getElementsByClassName("close")[0];
+var prevButton = document.getElementById('prevButton');
+var nextButton = document.getElementById('nextButton');
+
+function showMedia(position) {
+    if (position < 0 || position >= viewLength) {
+        return;
+    }
+    currentIndex = position;
+    withItem(viewItemAt(position), function(item) {
+        if (currentIndex === position) {
+            displayItem(item);
+        }
+    });
+}
+
+function displayItem(item) {
+    var src = item.src;
+    var type = item.type;
+    var fileExt = item.fileExt;
+    var mimeType = '';
+    originalLink.href = src;
+    modalInfo.textContent = describeItem(item);
+
+    if (type === "image") {
+        // Show the screen-sized preview; fall back to the original if it is missing
+        modalImg.onerror = function() {
+            modalImg.onerror = null;
+            modalImg.src = src;
+        };
+        modalImg.src = item.preview || src;
+        modalImg.style.display = "block";
+        modalVideo.style.display = "none";
+        modalMessage.style.display = "none";
+    } else if (type === "video") {
+        // Determine MIME type based on file extension; proxies are always H.264 MP4
+        if (item.proxy) {
+            src = item.proxy;
+            mimeType = 'video/mp4';
+        } else if (fileExt === 'mp4') {
+            mimeType = 'video/mp4';
+        } else if (fileExt === 'webm') {
+            mimeType = 'video/webm';
+        } else if (fileExt === 'ogg' || fileExt === 'ogv') {
+            mimeType = 'video/ogg';
+        } else {
+            mimeType = '';
+        }
+
+        modalVideoSource.src = src;
+        modalVideoSource.type = mimeType;
+        modalVideo.poster = item.preview || '';
+        modalVideo.load();
+
+        if (mimeType) {
+            modalVideo.style.display = "block";
+            modalImg.style.display = "none";
+            modalMessage.style.display = "none";
+        } else {
+            // Unsupported video format, show its preview frame above the download link
+            modalVideo.style.display = "none";
+            modalImg.onerror = null;
+            modalImg.src = item.preview || '';
+            modalImg.style.display = item.preview ? "block" : "none";
+            modalMessage.style.display = "block";
+            downloadLink.href = src;
+        }
+    }
+    modal.style.display = "block";
+}
+
+function closeModal() {
+    modal.style.display = "none";
+    modalVideo.pause();
+    modalVideo.style.display = "none";
+    modalImg.style.display = "none";
+    modalMessage.style.display = "none";
+}
+
+// Click event for thumbnails
+document.addEventListener('click', function(e) {
+    if (e.target && e.target.classList.contains('thumbnail')) {
+        var link = e.target.closest('.thumbnail-link');
+        showMedia(parseInt(link.dataset.position));
+        e.preventDefault();
+        return false;
+    } else if (e.target && e.target.classList.contains('modal-content')) {
+        closeModal();
+    }
+});
+
+// Next and Previous button functionality
+nextButton.onclick = function() {
+    if (currentIndex + 1 < viewLength) {
+        showMedia(currentIndex + 1);
+    }
+};
+
+prevButton.onclick = function() {
+    if (currentIndex - 1 >= 0) {
+        showMedia(currentIndex - 1);
+    }
+};
+
+// Close button functionality
+closeBtn.onclick = closeModal;
+
+window.onclick = function(event) {
+    if (event.target == modal) {
+        closeModal();
+    }
+};
+
+// Keyboard navigation
+document.addEventListener('keydown', function(e) {
+    if (modal.style.display === "block") {
+        if (e.key === 'ArrowRight' || e.key === 'Right') {
+            nextButton.onclick();
+        } else if (e.key === 'ArrowLeft' || e.key === 'Left') {
+            prevButton.onclick();
+        } else if (e.key === 'Escape' || e.key === 'Esc') {
+            closeBtn.onclick();
+        }
+    }
+});
+"""
+
+GALLERY_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 100'><rect x='10' y='10' width='80' height='80' rx='10' fill='%234a90e2'/><circle cx='50' cy='50' r='30' fill='%23f5a623'/><path d='M50 20 L80 50 L50 80 L20 50 Z' fill='%23fff'/></svg>" />
+    <title>Media Gallery</title>
+    <link rel="stylesheet" href="{asset_dir}/gallery.css">
+</head>
+<body>
+    <h1>Media Gallery</h1>
+    <div class="toolbar">
+        <input type="search" id="searchInput" placeholder="Search file and album names">
+        <label>From <input type="date" id="dateFrom"></label>
+        <label>To <input type="date" id="dateTo"></label>
+        <label>View <select id="viewMode">
+            <option value="albums">Albums</option>
+            <option value="months">Albums by month</option>
+            <option value="timeline">Timeline</option>
+        </select></label>
+        <span id="searchStatus"></span>
+        <a href="catalog.html">All discs</a>
+    </div>
+    <div id="gallery"></div>
+    <div id="mediaModal" class="modal">
+        <span class="close">&times;</span>
+        <div class="modal-content">
+            <button class="nav-button" id="prevButton">&#10094;</button>
+            <img id="modalImage" src="" style="display:none;">
+            <video id="modalVideo" controls style="display:none;">
+                <source id="modalVideoSource" src="" type="">
+                Your browser does not support the video tag.
+            </video>
+            <div id="modalMessage" style="display:none; color: white; text-align: center;">
+                This video format is not supported by your browser.
+                <a id="modalDownloadLink" href="" style="color: #0af;">Click here to download the video.</a>
+            </div>
+            <div id="modalInfo" class="modal-info"></div>
+            <a id="modalOriginalLink" class="original-link" href="" target="_blank">Open original</a>
+            <button class="nav-button" id="nextButton">&#10095;</button>
+        </div>
+    </div>
+    <script src="{asset_dir}/gallery.js"></script>
+    <script src="{asset_dir}/index.js"></script>
+</body>
+</html>
+"""
+
+def rendition_paths(relative_path, thumb_ext):
+    """Return the (thumb, thumb 2x, preview) paths for a media file, relative to the same root."""
+    directory, file_name = os.path.split(relative_path)
+    stem = os.path.splitext(file_name)[0]
+    return (
+        os.path.join(directory, 'thumbs', f"{stem}{thumb_ext}"),
+        os.path.join(directory, 'thumbs', f"{stem}@2x{thumb_ext}"),
+        os.path.join(directory, 'previews', f"{stem}{thumb_ext}"),
+    )
+
+def gallery_chunk_name(album_index, chunk_index):
+    return f"a{album_index:05d}_{chunk_index:03d}.js"
+
+def write_gallery_assets(disc_dir):
+    asset_dir = os.path.join(disc_dir, GALLERY_ASSET_DIR)
+    os.makedirs(asset_dir, exist_ok=True)
+    pages = (
+        (os.path.join(asset_dir, 'gallery.css'), GALLERY_CSS),
+        (os.path.join(asset_dir, 'gallery.js'), GALLERY_JS),
+        (os.path.join(disc_dir, 'index.html'), GALLERY_PAGE.format(asset_dir=GALLERY_ASSET_DIR)),
+    )
+    for asset_path, content in pages:
+        try:
+            with open(asset_path, 'r', encoding='utf-8') as f:
+                if f.read() == content:
+                    continue
+        except OSError:
+            pass
+        with open(asset_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+def album_months(files):
+    """[[month, count], ...] runs of an album's date-sorted files, with None for the undated ones."""
+    months = []
+    for _, _, date_taken, _ in files:
+        month = date_taken.strftime('%Y-%m') if isinstance(date_taken, datetime) else None
+        if months and months[-1][0] == month:
+            months[-1][1] += 1
+        else:
+            months.append([month, 1])
+    return months
+
+def gallery_entry(file_path, file_type, date_taken, details):
+    # [path, type, date, width, height, duration, camera], without the unknown values at the end. The type
+    # is 'i' for images, 'v' for videos and 'p' for videos with a proxy.
+    entry = [file_path, {'image': 'i', 'video': 'v', 'proxy': 'p'}[file_type],
+             date_taken.strftime('%Y-%m-%d %H:%M') if isinstance(date_taken, datetime) else None] + list(details)
+    while entry[-1] is None:
+        entry.pop()
+    return entry
+
+def write_gallery_index(disc_dir, albums, thumb_ext, chunk_size=GALLERY_CHUNK_SIZE):
+    """Stream the media index for albums: a small album list plus per-album item chunks loaded on demand."""
+    asset_dir = os.path.join(disc_dir, GALLERY_ASSET_DIR)
+    data_dir = os.path.join(asset_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    for stale in os.listdir(data_dir):
+        os.remove(os.path.join(data_dir, stale))
+
+    album_entries = []
+    start = 0
+    for album_index, (album_name, files) in enumerate(albums.items()):
+        chunk_count = (len(files) + chunk_size - 1) // chunk_size
+        for chunk_index in range(chunk_count):
+            chunk = files[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+            with open(os.path.join(data_dir, gallery_chunk_name(album_index, chunk_index)), 'w', encoding='utf-8') as out:
+                out.write(f"galleryLoadChunk({album_index},{chunk_index},[\n")
+                for i, item in enumerate(chunk):
+                    entry = json.dumps(gallery_entry(*item), ensure_ascii=False)
+                    out.write(f",{entry}\n" if i else f"{entry}\n")
+                out.write("]);\n")
+        album_entries.append({'name': album_name, 'count': len(files), 'start': start, 'chunks': chunk_count,
+                              'months': album_months(files)})
+        start += len(files)
+
+    index = {
+        'total': start,
+        'chunkSize': chunk_size,
+        'dataDir': f"{GALLERY_ASSET_DIR}/data",
+        'thumbExt': thumb_ext,
+        'thumbWidths': [THUMBNAIL_SIZE[0], THUMBNAIL_2X_SIZE[0]],
+        'searchFile': f"{GALLERY_ASSET_DIR}/search.js",
+        'albums': album_entries,
+    }
+    with open(os.path.join(asset_dir, 'index.js'), 'w', encoding='utf-8') as out:
+        out.write(f"galleryLoadIndex({json.dumps(index, ensure_ascii=False)});\n")
+
+def search_tokens(text):
+    # Must split the same way as tokenize() in gallery.js
+    return [token for token in re.split(r'[\W_]+', text.lower()) if token]
+
+def encode_postings(ids):
+    # Ascending ids as comma separated base-36 deltas, decoded by decodePostings() in gallery.js
+    parts = []
+    previous = 0
+    for item_id in ids:
+        delta = item_id - previous
+        digits = ''
+        while True:
+            delta, remainder = divmod(delta, 36)
+            digits = '0123456789abcdefghijklmnopqrstuvwxyz'[remainder] + digits
+            if not delta:
+                break
+        parts.append(digits)
+        previous = item_id
+    return ','.join(parts)
+
+def write_search_index(disc_dir, albums):
+    """Write _gallery/search.js: sorted token tables with postings, and per-item capture days for date filtering."""
+    item_tokens = defaultdict(list)
+    album_tokens = defaultdict(list)
+    days = []
+    epoch = datetime(1970, 1, 1)
+    item_id = 0
+    for album_index, (album_name, files) in enumerate(albums.items()):
+        for token in set(search_tokens(album_name)):
+            album_tokens[token].append(album_index)
+        for file_path, _, date_taken, details in files:
+            for token in set(search_tokens(os.path.basename(file_path)) + search_tokens(details[3] or '')):
+                item_tokens[token].append(item_id)
+            days.append((date_taken - epoch).days if isinstance(date_taken, datetime) else None)
+            item_id += 1
+
+    item_token_list = sorted(item_tokens)
+    album_token_list = sorted(album_tokens)
+    by_date = sorted((i for i, day in enumerate(days) if day is not None), key=lambda i: (days[i], i))
+    index = {
+        'tokens': item_token_list,
+        'postings': [encode_postings(item_tokens[token]) for token in item_token_list],
+        'albumTokens': album_token_list,
+        'albumPostings': [encode_postings(album_tokens[token]) for token in album_token_list],
+        'days': days,
+        'byDate': by_date,
+    }
+    with open(os.path.join(disc_dir, GALLERY_ASSET_DIR, 'search.js'), 'w', encoding='utf-8') as out:
+        out.write(f"gallerySearchIndex({json.dumps(index, ensure_ascii=False, separators=(',', ':'))});\n")
+
+
+# Master catalog: one SQLite file indexing every archived file across all discs, copied onto each disc
+CATALOG_NAME = 'catalog.sqlite'
+CATALOG_SHARD_TARGET = 2000  # entries per shard of the catalog page's lookup table
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    disc INTEGER NOT NULL,
+    disc_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL,
+    date_taken TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_source_path ON files (source_path);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_date_taken ON files (date_taken);
+CREATE UNIQUE INDEX IF NOT EXISTS files_disc_path ON files (disc, disc_path);
+CREATE TABLE IF NOT EXISTS discs (disc INTEGER PRIMARY KEY, completed TEXT);
+"""
+
+def open_catalog(catalog_path, source_root=None):
+    conn = sqlite3.connect(catalog_path)
+    tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.executescript(CATALOG_SCHEMA)
+    if 'files' in tables and 'discs' not in tables:
+        # Catalogs from before discs were tracked only hold discs that were written
+        with conn:
+            conn.execute("INSERT INTO discs (disc, completed) SELECT DISTINCT disc, ? FROM files",
+                         (datetime.now().isoformat(timespec='seconds'),))
+    if source_root:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source_root', ?)", (source_root,))
+    return conn
+
+def open_catalog_readonly(catalog_path):
+    # immutable=1 skips locking, which read-only optical media does not support
+    uri = pathlib.Path(os.path.abspath(catalog_path)).as_uri() + '?immutable=1'
+    return sqlite3.connect(uri, uri=True)
+
+def reset_catalog(conn):
+    with conn:
+        conn.execute("DELETE FROM files")
+        conn.execute("DELETE FROM discs")
+
+def discard_incomplete_discs(conn):
+    """Forget the discs a previous run planned but never finished, so their files are archived again and their
+    numbers are reused. Returns {disc: [(source path, path on the disc), ...]} for the discs discarded."""
+    with conn:
+        incomplete = {disc: [] for disc, in conn.execute("SELECT disc FROM discs WHERE completed IS NULL")}
+        for disc in incomplete:
+            incomplete[disc] = conn.execute("SELECT source_path, disc_path FROM files WHERE disc = ?", (disc,)).fetchall()
+        conn.executemany("DELETE FROM files WHERE disc = ?", [(disc,) for disc in incomplete])
+        conn.executemany("DELETE FROM discs WHERE disc = ?", [(disc,) for disc in incomplete])
+    return incomplete
+
+def clear_discarded_disc(dest_dir, source_dir, disc_index, files):
+    """Remove what an unfinished run left of Disc_N (its directory, ISO staging directory, image and error log)
+    so the disc that reuses the number starts empty. A file a --move run already moved onto the disc is moved
+    back to the source first, so the rescan finds it. Returns the number of files moved back."""
+    disc_dir = os.path.join(dest_dir, f"Disc_{disc_index}")
+    restored = 0
+    for source_path, disc_path in files:
+        staged = os.path.join(disc_dir, disc_path)
+        original = os.path.join(source_dir, source_path)
+        if os.path.isfile(staged) and not os.path.exists(original):
+            os.makedirs(os.path.dirname(original), exist_ok=True)
+            shutil.move(staged, original)
+            restored += 1
+    shutil.rmtree(disc_dir, ignore_errors=True)
+    for leftover in (f"Disc_{disc_index}.iso", f"error_log_disc_{disc_index}.txt"):
+        if os.path.exists(os.path.join(dest_dir, leftover)):
+            os.remove(os.path.join(dest_dir, leftover))
+    return restored
+
+def catalog_source_path(album_name, file_path):
+    return os.path.normpath(os.path.join(album_name, file_path)).replace(os.sep, '/')
+
+def next_disc_index(conn):
+    return (conn.execute("SELECT MAX(disc) FROM files").fetchone()[0] or 0) + 1
+
+def load_archived_files(conn):
+    """Map each archived source path to the (size, mtime) of its newest copy. Only files that were written to
+    a completed disc count; a file whose copy failed has no hash."""
+    rows = conn.execute("SELECT source_path, size, mtime, MAX(files.disc) FROM files JOIN discs ON discs.disc = files.disc "
+                        "WHERE discs.completed IS NOT NULL AND files.sha256 IS NOT NULL GROUP BY source_path")
+    return {source_path: (size, mtime) for source_path, size, mtime, _ in rows}
+
+def record_disc_plan(conn, disc_index, disc, inventory):
+    rows = []
+    for row in disc:
+        date_taken = inventory.date_taken(row)
+        rows.append((
+            inventory.catalog_path(row),
+            os.path.basename(inventory.name(row)).lower(),
+            disc_index,
+            inventory.disc_path(row),
+            inventory.size[row],
+            inventory.mtime[row],
+            date_taken.isoformat(sep=' ') if date_taken else None,
+        ))
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO discs (disc, completed) VALUES (?, NULL)", (disc_index,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO files (source_path, name, disc, disc_path, size, mtime, date_taken) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+def mark_disc_complete(conn, disc_index):
+    """Record that a disc has been fully written, so an incremental run treats its files as archived."""
+    with conn:
+        conn.execute("UPDATE discs SET completed = ? WHERE disc = ?", (datetime.now().isoformat(timespec='seconds'), disc_index))
+
+def record_disc_hashes(conn, disc_index, disc_hashes):
+    with conn:
+        conn.executemany("UPDATE files SET sha256 = ? WHERE disc = ? AND disc_path = ?",
+                         [(file_hash, disc_index, disc_path) for disc_path, file_hash in disc_hashes.items()])
+
+def catalog_shard(name, shard_count):
+    # 32-bit FNV-1a over the UTF-8 bytes, mirrored by shardOf() in catalog.js
+    h = 0x811c9dc5
+    for byte in name.encode('utf-8'):
+        h = ((h ^ byte) * 0x01000193) & 0xffffffff
+    return h % shard_count
+
+def write_catalog_pages(conn, disc_dir, disc_index):
+    """Write catalog.html and its sharded lookup data so the page can find any file across all discs."""
+    asset_dir = os.path.join(disc_dir, GALLERY_ASSET_DIR)
+    data_dir = os.path.join(asset_dir, 'catalog')
+    os.makedirs(data_dir, exist_ok=True)
+    for stale in os.listdir(data_dir):
+        os.remove(os.path.join(data_dir, stale))
+
+    total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    shard_count = 16
+    while shard_count * CATALOG_SHARD_TARGET < total and shard_count < 4096:
+        shard_count *= 2
+
+    shards = defaultdict(list)
+    query = "SELECT name, disc, disc_path, source_path, date_taken, size, sha256 FROM files ORDER BY disc, disc_path"
+    for row in conn.execute(query):
+        shards[catalog_shard(row[0], shard_count)].append(row)
+    # Every shard is written, even an empty one, since the page loads the shard a name hashes to and waits for it
+    for shard in range(shard_count):
+        rows = shards.get(shard, [])
+        with open(os.path.join(data_dir, f"s{shard:04d}.js"), 'w', encoding='utf-8') as out:
+            out.write(f"catalogShard({shard},[\n")
+            for i, row in enumerate(rows):
+                entry = json.dumps(list(row[1:]), ensure_ascii=False)
+                out.write(f",{entry}\n" if i else f"{entry}\n")
+            out.write("]);\n")
+
+    discs = [
+        {'disc': disc, 'files': files, 'size': size, 'earliest': earliest, 'latest': latest}
+        for disc, files, size, earliest, latest in conn.execute(
+            "SELECT disc, COUNT(*), SUM(size), MIN(date_taken), MAX(date_taken) FROM files GROUP BY disc ORDER BY disc")
+    ]
+    summary = {'current': disc_index, 'shards': shard_count, 'total': total, 'discs': discs}
+    with open(os.path.join(data_dir, 'discs.js'), 'w', encoding='utf-8') as out:
+        out.write(f"catalogDiscs({json.dumps(summary, ensure_ascii=False)});\n")
+
+    for asset_path, content in ((os.path.join(asset_dir, 'catalog.js'), CATALOG_JS),
+                                (os.path.join(disc_dir, 'catalog.html'), CATALOG_PAGE.format(asset_dir=GALLERY_ASSET_DIR))):
+        with open(asset_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+def export_catalog_to_disc(conn, disc_dir, disc_index):
+    conn.commit()
+    catalog_path = os.path.join(disc_dir, CATALOG_NAME)
+    if os.path.exists(catalog_path):
+        os.remove(catalog_path)
+    disc_catalog = sqlite3.connect(catalog_path)
+    with disc_catalog:
+        conn.backup(disc_catalog)
+        # The copy is the last thing written before the disc's recovery data, so it records its own disc as
+        # completed; the master catalog only does once the recovery data is written too
+        disc_catalog.execute("UPDATE discs SET completed = ? WHERE disc = ?",
+                             (datetime.now().isoformat(timespec='seconds'), disc_index))
+    disc_catalog.close()
+    write_catalog_pages(conn, disc_dir, disc_index)
+
+CATALOG_JS = """// Cross-disc lookup. discs.js summarises every disc; the per-file entries are sharded by a
+// hash of the lower-cased file name, so a lookup loads exactly one small shard.
+var catalog = null;
+var catalogShards = {};
+var pendingLookup = null;
+
+function catalogDiscs(data) {
+    catalog = data;
+}
+
+function catalogShard(shard, entries) {
+    catalogShards[shard] = entries;
+    if (pendingLookup !== null && shardOf(pendingLookup) === shard) {
+        showMatches(pendingLookup);
+    }
+}
+
+// 32-bit FNV-1a over the UTF-8 bytes, mirrored by catalog_shard() in process.py
+function shardOf(name) {
+    var bytes = new TextEncoder().encode(name);
+    var h = 0x811c9dc5;
+    for (var i = 0; i < bytes.length; i++) {
+        h ^= bytes[i];
+        h = Math.imul(h, 0x01000193) >>> 0;
+    }
+    return h % catalog.shards;
+}
+
+function formatSize(bytes) {
+    return (bytes / (1024 * 1024 * 1024)).toFixed(2) + ' GB';
+}
+
+function cell(row, text) {
+    var td = document.createElement('td');
+    td.textContent = text === null || text === undefined ? '' : text;
+    row.appendChild(td);
+    return td;
+}
+
+function showDiscs() {
+    var table = document.getElementById('discTable');
+    catalog.discs.forEach(function(disc) {
+        var row = document.createElement('tr');
+        cell(row, 'Disc ' + disc.disc + (disc.disc === catalog.current ? ' (this disc)' : ''));
+        cell(row, disc.files);
+        cell(row, formatSize(disc.size));
+        cell(row, (disc.earliest || '').slice(0, 10) + ' - ' + (disc.latest || '').slice(0, 10));
+        table.appendChild(row);
+    });
+}
+
+function showMatches(name) {
+    var results = document.getElementById('catalogResults');
+    var entries = catalogShards[shardOf(name)];
+    results.innerHTML = '';
+    pendingLookup = null;
+    var matches = entries.filter(function(entry) {
+        return entry[1].slice(entry[1].lastIndexOf('/') + 1).toLowerCase() === name;
+    });
+    document.getElementById('catalogStatus').textContent = matches.length + (matches.length === 1 ? ' match' : ' matches');
+    matches.forEach(function(entry) {
+        var row = document.createElement('tr');
+        cell(row, 'Disc ' + entry[0]);
+        var pathCell = cell(row, '');
+        if (entry[0] === catalog.current) {
+            var link = document.createElement('a');
+            link.href = entry[1].split('/').map(encodeURIComponent).join('/');
+            link.textContent = entry[1];
+            pathCell.appendChild(link);
+        } else {
+            pathCell.textContent = entry[1];
+        }
+        cell(row, entry[2]);
+        cell(row, (entry[3] || '').slice(0, 10));
+        cell(row, entry[5] || '');
+        results.appendChild(row);
+    });
+}
+
+function lookup() {
+    var name = document.getElementById('catalogInput').value.trim().toLowerCase();
+    if (!name) {
+        return;
+    }
+    var shard = shardOf(name);
+    if (catalogShards[shard]) {
+        showMatches(name);
+        return;
+    }
+    pendingLookup = name;
+    document.getElementById('catalogStatus').textContent = 'Loading...';
+    var script = document.createElement('script');
+    script.src = '_gallery/catalog/s' + ('000' + shard).slice(-4) + '.js';
+    // A missing shard means no file has a name that hashes to it
+    script.onerror = function() {
+        catalogShard(shard, []);
+    };
+    document.head.appendChild(script);
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    if (!catalog) {
+        document.getElementById('catalogStatus').textContent = 'The catalog (_gallery/catalog/discs.js) could not be loaded.';
+        return;
+    }
+    document.getElementById('catalogSummary').textContent =
+        catalog.total + ' files on ' + catalog.discs.length + ' discs. You are viewing Disc ' + catalog.current + '.';
+    showDiscs();
+    document.getElementById('catalogForm').addEventListener('submit', function(e) {
+        e.preventDefault();
+        lookup();
+    });
+});
+"""
+
+CATALOG_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Archive Catalog</title>
+    <link rel="stylesheet" href="{asset_dir}/gallery.css">
+</head>
+<body>
+    <h1>Archive Catalog</h1>
+    <p><a href="index.html">Back to this disc's gallery</a></p>
+    <p id="catalogSummary"></p>
+    <form id="catalogForm" class="toolbar">
+        <input type="search" id="catalogInput" placeholder="Exact file name, e.g. IMG_1234.JPG">
+        <button type="submit">Find</button>
+        <span id="catalogStatus"></span>
+    </form>
+    <table class="catalog-table">
+        <thead><tr><th>Disc</th><th>Path on disc</th><th>Original path</th><th>Date</th><th>SHA-256</th></tr></thead>
+        <tbody id="catalogResults"></tbody>
+    </table>
+    <h2>Discs</h2>
+    <table class="catalog-table">
+        <thead><tr><th>Disc</th><th>Files</th><th>Size</th><th>Dates</th></tr></thead>
+        <tbody id="discTable"></tbody>
+    </table>
+    <script src="{asset_dir}/catalog.js"></script>
+    <script src="{asset_dir}/catalog/discs.js"></script>
+</body>
+</html>
+"""
+
+def looks_like_date(query):
+    return re.fullmatch(r'\d{4}(-\d{2}(-\d{2})?)?', query) is not None
+
+def lookup_catalog(conn, query, by=None, source_root=None):
+    """Return catalog rows matching query, guessing whether it is a hash, path, date or file name."""
+    if by is None:
+        if re.fullmatch(r'[0-9a-fA-F]{8,64}', query):
+            by = 'hash'
+        elif looks_like_date(query):
+            by = 'date'
+        elif '/' in query or os.sep in query:
+            by = 'path'
+        else:
+            by = 'name'
+
+    columns = "disc, disc_path, source_path, date_taken, size, sha256"
+    if by == 'hash':
+        prefix = query.lower()
+        sql = f"SELECT {columns} FROM files WHERE sha256 >= ? AND sha256 < ? ORDER BY disc"
+        return conn.execute(sql, (prefix, prefix + 'g')).fetchall()
+    if by == 'date':
+        sql = f"SELECT {columns} FROM files WHERE date_taken >= ? AND date_taken < ? ORDER BY date_taken"
+        return conn.execute(sql, (query, query + '~')).fetchall()
+    if by == 'path':
+        path = query
+        if source_root and os.path.isabs(path):
+            path = os.path.relpath(path, source_root)
+        path = path.replace(os.sep, '/')
+        sql = f"SELECT {columns} FROM files WHERE source_path = ? OR disc_path = ? ORDER BY disc"
+        return conn.execute(sql, (path, path)).fetchall()
+    sql = f"SELECT {columns} FROM files WHERE name = ? ORDER BY disc"
+    return conn.execute(sql, (os.path.basename(query).lower(),)).fetchall()
+
+def lookup_main(argv):
+    parser = argparse.ArgumentParser(prog="process.py lookup", description="Find which disc holds a file.")
+    parser.add_argument('catalog', help=f"Path to {CATALOG_NAME}, or a destination/disc directory containing it")
+    parser.add_argument('query', help="File name, original path, SHA-256 (or prefix), or YYYY[-MM[-DD]] date")
+    parser.add_argument('--by', choices=['name', 'path', 'hash', 'date'], help="Force the kind of lookup")
+    args = parser.parse_args(argv)
+
+    catalog_path = args.catalog
+    if os.path.isdir(catalog_path):
+        catalog_path = os.path.join(catalog_path, CATALOG_NAME)
+    if not os.path.exists(catalog_path):
+        print(f"Error: catalog '{catalog_path}' does not exist.")
+        return 1
+
+    conn = open_catalog_readonly(catalog_path)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'source_root'").fetchone()
+    rows = lookup_catalog(conn, args.query, args.by, row[0] if row else None)
+    conn.close()
+
+    if not rows:
+        print("No matching files in the catalog.")
+        return 1
+    for disc, disc_path, source_path, date_taken, size, sha256 in rows:
+        print(f"Disc_{disc}: {disc_path}")
+        print(f"    source: {source_path}  date: {date_taken or 'unknown'}  size: {size}  sha256: {sha256 or 'pending'}")
+    return 0
+
+def check_free_space(path, required, what):
+    """Raise OSError unless the filesystem holding path has required bytes free for what."""
+    available = shutil.disk_usage(path).free
+    if required > available:
+        raise OSError(f"Not enough disk space for {what}. Required: {required}, Available: {available}")
+
+def preflight_disc(disc_dir, disc, inventory, move=False):
+    """Prepare disc_dir for copying disc's rows with one check per disc instead of several syscalls per file:
+    free space against the planned disc size, the album directories created in one pass, and the source
+    albums checked for readability once each. The files themselves were listed by the scan, so the workers
+    only transfer data and still report a file that cannot be read. Returns (rows to copy, per-file errors)."""
+    # Split albums put their segments in separate folders on the disc
+    rows_by_folder = defaultdict(lambda: defaultdict(list))
+    for row in disc:
+        rows_by_folder[inventory.album[row]][os.path.dirname(inventory.disc_path(row))].append(row)
+
+    required = inventory.total_size(disc)
+    if move and os.stat(inventory.source_dir).st_dev == os.stat(disc_dir).st_dev:
+        required = 0    # a rename on the same filesystem takes no extra room
+    check_free_space(disc_dir, required, os.path.basename(disc_dir))
+
+    rows = array('q')
+    errors = []
+    for album_id, folders in rows_by_folder.items():
+        album_dir = os.path.join(inventory.source_dir, inventory.albums[album_id])
+        if not os.access(album_dir, os.R_OK | os.X_OK):
+            errors.extend(f"No read permission for source file: {os.path.join(inventory.source_dir, inventory.source_path(row))}"
+                          for folder_rows in folders.values() for row in folder_rows)
+            continue
+        for folder, folder_rows in folders.items():
+            dest_dir = os.path.join(disc_dir, folder)
+            try:
+                os.makedirs(dest_dir, exist_ok=True)
+            except OSError as e:
+                errors.append(f"Failed to create destination directory {dest_dir}: {str(e)}")
+                continue
+            rows.extend(folder_rows)
+    for error in errors:
+        logging.error(error)
+    return rows, errors
+
+def process_file(args):
+    """Copy or move one row into current_disc_dir, whose directories preflight_disc has created."""
+    global source_dir_global, dest_dir_global, move_files_global, file_hashes
+    row, current_disc_dir = args
+    file_size = inventory.size[row]
+    source_path = os.path.join(source_dir_global, inventory.source_path(row))
+    # The segment name (which might include a part number) is the folder on the disc
+    dest_path = os.path.join(current_disc_dir, inventory.disc_path(row))
+
+    try:
+        if move_files_global:
+            shutil.move(source_path, dest_path)
+        else:
+            shutil.copy2(source_path, dest_path)
+    except Exception as e:
+        error_msg = f"{'Move' if move_files_global else 'Copy'} operation failed for {source_path}: {str(e)}"
+        logging.error(error_msg)
+        return None, 0, None, error_msg
+
+    # Log successful operation; the event writer also appends it to processed_files.log
+    logging.debug(f"Successfully processed file: {source_path} -> {dest_path}",
+                  extra={'processed': f"Successfully {'moved' if move_files_global else 'copied'}: {source_path} -> {dest_path}"})
+    return source_path, file_size, dest_path, None
+
+# Recovery data. Every file on a disc (except _parity/ itself) is read as one stream in path order and cut
+# into blocks. The blocks are protected by a systematic Reed-Solomon erasure code over GF(2^8): a segment
+# of the stream is laid out as rows of PARITY_WIDTH blocks, each column is a stripe with its own parity
+# blocks, so a contiguous run of damage is spread across all the stripes of its segment. Per-block hashes
+# tell the repair command which blocks are bad; it rebuilds them from the surviving blocks of each stripe.
+PARITY_DIR = '_parity'
+PARITY_BLOCK_SIZE = 64 * 1024
+PARITY_WIDTH = 64   # stripes per segment
+PARITY_ROWS = 200   # data blocks per stripe; rows plus parity blocks must stay within the field's 255
+PARITY_MAX_FRACTION = 0.25
+PARITY_DIGEST_SIZE = 16
+GF_POLYNOMIAL = 0x11d
+
+def gf_tables():
+    exp = [0] * 512
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLYNOMIAL
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+GF_EXP, GF_LOG = gf_tables()
+gf_mul_table = None
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+def gf_multiplier():
+    """256x256 NumPy product table: gf_multiplier()[c][blocks] multiplies a whole array of bytes by c."""
+    global gf_mul_table
+    if gf_mul_table is None:
+        import numpy as np
+        table = np.zeros((256, 256), dtype=np.uint8)
+        for a in range(1, 256):
+            table[a, 1:] = [GF_EXP[GF_LOG[a] + GF_LOG[b]] for b in range(1, 256)]
+        gf_mul_table = table
+    return gf_mul_table
+
+def packed_multiplier(multiply, coefficients):
+    """Table mapping a byte to its products with up to 8 coefficients, packed side by side into one integer,
+    so a single lookup per data byte feeds several parity blocks at once."""
+    import numpy as np
+    lanes = 1 << (len(coefficients) - 1).bit_length()
+    table = np.zeros((256, lanes), dtype=np.uint8)
+    table[:, :len(coefficients)] = multiply[coefficients].T
+    return table.view(np.dtype(f'u{lanes}')).ravel()
+
+def parity_coefficients(parity_count, rows):
+    # Cauchy matrix 1 / (x_r + y_i) with x_r = r and y_i = parity_count + i: every square submatrix is
+    # invertible, so any parity_count erased blocks of a stripe can be rebuilt from any intact parity blocks
+    return [[gf_inv(r ^ (parity_count + i)) for i in range(rows)] for r in range(parity_count)]
+
+def gf_invert_matrix(matrix):
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next(r for r in range(col, size) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(value, scale) for value in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+def parity_overhead(fraction):
+    """Share of a disc taken by recovery data for a given parity fraction, for the packer."""
+    if not fraction:
+        return 0
+    return math.ceil(PARITY_ROWS * fraction) / PARITY_ROWS
+
+def parity_layout(total_size, fraction, block_size=PARITY_BLOCK_SIZE, width=PARITY_WIDTH, rows=PARITY_ROWS):
+    data_blocks = -(-total_size // block_size)
+    segments = []
+    parity_block = 0
+    for first_block in range(0, data_blocks, width * rows):
+        blocks = min(width * rows, data_blocks - first_block)
+        # A short final segment uses fewer stripes, so its parity stays close to the requested fraction
+        segment_width = min(width, -(-blocks // rows))
+        segment_rows = -(-blocks // segment_width)
+        parity_count = max(1, math.ceil(segment_rows * fraction))
+        segments.append({'first_block': first_block, 'blocks': blocks, 'width': segment_width,
+                         'rows': segment_rows, 'parity': parity_count, 'parity_block': parity_block})
+        parity_block += parity_count * segment_width
+    return data_blocks, segments, parity_block
+
+class DiscStream:
+    """Reads byte ranges of the concatenation of (path, offset, size) sources, starting at stream offset origin."""
+    def __init__(self, sources, origin=0):
+        self.sources = sources
+        self.starts = list(itertools.accumulate([origin] + [size for _, _, size in sources]))
+        self.file = None
+        self.file_path = None
+
+    def _open(self, path):
+        if self.file_path != path:
+            self.close()
+            self.file = open(path, 'rb')
+            self.file_path = path
+        return self.file
+
+    def read(self, offset, length):
+        chunks = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and 0 <= index < len(self.sources):
+            path, base, size = self.sources[index]
+            within = offset - self.starts[index]
+            count = min(length, size - within)
+            if count > 0:
+                source = self._open(path)
+                source.seek(base + within)
+                data = source.read(count)
+                chunks.append(data + b'\0' * (count - len(data)))
+                offset += count
+                length -= count
+            index += 1
+        chunks.append(b'\0' * length)
+        return b''.join(chunks)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.file_path = None
+
+def block_digest(block):
+    return hashlib.blake2b(block, digest_size=PARITY_DIGEST_SIZE).digest()
+
+def segment_sources(sources, starts, segment, block_size):
+    # Only the files overlapping a segment are sent to the worker that encodes or checks it
+    begin = segment['first_block'] * block_size
+    end = begin + segment['blocks'] * block_size
+    first = max(0, bisect.bisect_right(starts, begin) - 1)
+    last = bisect.bisect_left(starts, end)
+    return sources[first:last], starts[first]
+
+def encode_parity_segment(args):
+    import numpy as np
+    sources, origin, segment, block_size = args
+    multiply = gf_multiplier()
+    width, parity_count = segment['width'], segment['parity']
+    coefficients = parity_coefficients(parity_count, segment['rows'])
+    # Parity blocks are accumulated in groups of up to 8, one byte lane per parity block, and updated one
+    # data block at a time so the lookups and XORs stay in cache
+    groups = [list(range(g, min(g + 8, parity_count))) for g in range(0, parity_count, 8)]
+    accumulators = []
+    for group in groups:
+        lanes = 1 << (len(group) - 1).bit_length()
+        accumulators.append((np.zeros(width * block_size, dtype=np.dtype(f'u{lanes}')),
+                             np.empty(block_size, dtype=np.dtype(f'u{lanes}'))))
+    data_digests = []
+    stream = DiscStream(sources, origin)
+    try:
+        for row in range(segment['rows']):
+            first = segment['first_block'] + row * width
+            count = min(width, segment['first_block'] + segment['blocks'] - first)
+            blocks = np.frombuffer(stream.read(first * block_size, count * block_size), dtype=np.uint8)
+            tables = [packed_multiplier(multiply, [coefficients[r][row] for r in group]) for group in groups]
+            for j in range(count):
+                block = blocks[j * block_size:(j + 1) * block_size]
+                data_digests.append(block_digest(block))
+                for table, (accumulator, products) in zip(tables, accumulators):
+                    np.take(table, block, out=products)
+                    window = accumulator[j * block_size:(j + 1) * block_size]
+                    np.bitwise_xor(window, products, out=window)
+    finally:
+        stream.close()
+    parity = np.empty((parity_count, width, block_size), dtype=np.uint8)
+    for group, (accumulator, _) in zip(groups, accumulators):
+        lanes = accumulator.view(np.uint8).reshape(width * block_size, -1)
+        for lane, r in enumerate(group):
+            parity[r] = lanes[:, lane].reshape(width, block_size)
+    parity_digests = [block_digest(parity[r, j]) for r in range(parity_count) for j in range(width)]
+    return parity.tobytes(), b''.join(data_digests), b''.join(parity_digests)
+
+def write_disc_parity(parity_dir, files, sources, fraction):
+    """Write parity.json, hashes.bin and parity.bin for a disc into parity_dir. files lists (disc path,
+    size) and sources the matching (path to read, offset, size) in the same order."""
+    from tqdm import tqdm
+    os.makedirs(parity_dir, exist_ok=True)
+    total_size = sum(size for _, size in files)
+    data_blocks, segments, parity_blocks = parity_layout(total_size, fraction)
+    starts = list(itertools.accumulate([0] + [size for _, _, size in sources]))
+    tasks = [segment_sources(sources, starts, segment, PARITY_BLOCK_SIZE) + (segment, PARITY_BLOCK_SIZE)
+             for segment in segments]
+
+    data_digests = []
+    parity_digests = []
+    with open(os.path.join(parity_dir, 'parity.bin'), 'wb') as parity_file, run_report.stage('parity'):
+        run_report.record('parity', files=len(files), size=total_size)
+        with multiprocessing.Pool(processes=getCPUs(), **pool_initializer('parity')) as pool:
+            for (parity, data_digest, parity_digest), _, cpu_seconds in tqdm(
+                    pool.imap(partial(timed_task, encode_parity_segment), tasks), total=len(tasks),
+                    desc="Encoding recovery data", unit="segment"):
+                run_report.record('parity', cpu_seconds=cpu_seconds, files=0)
+                parity_file.write(parity)
+                data_digests.append(data_digest)
+                parity_digests.append(parity_digest)
+            pool.close()
+            pool.join()
+    with open(os.path.join(parity_dir, 'hashes.bin'), 'wb') as f:
+        f.write(b''.join(data_digests + parity_digests))
+    with open(os.path.join(parity_dir, 'parity.json'), 'w', encoding='utf-8') as f:
+        f.write(parity_index_json(files, fraction, data_blocks, segments, parity_blocks))
+
+def parity_index_json(files, fraction, data_blocks, segments, parity_blocks):
+    return json.dumps({'version': 1, 'block_size': PARITY_BLOCK_SIZE, 'fraction': fraction,
+                       'digest_size': PARITY_DIGEST_SIZE, 'data_blocks': data_blocks, 'parity_blocks': parity_blocks,
+                       'segments': segments, 'files': [[path, size] for path, size in files]}, indent=1)
+
+def disc_directory_files(disc_dir):
+    files = []
+    for root, dirs, names in os.walk(disc_dir):
+        if root == disc_dir and PARITY_DIR in dirs:
+            dirs.remove(PARITY_DIR)
+        for name in names:
+            file_path = os.path.join(root, name)
+            files.append((os.path.relpath(file_path, disc_dir).replace(os.sep, '/'), os.path.getsize(file_path)))
+    return sorted(files)
+
+def write_directory_parity(disc_dir, fraction):
+    files = disc_directory_files(disc_dir)
+    sources = [(os.path.join(disc_dir, path), 0, size) for path, size in files]
+    write_disc_parity(os.path.join(disc_dir, PARITY_DIR), files, sources, fraction)
+
+def check_parity_segment(args):
+    """Hash every block of a segment and rebuild the bad data blocks of each stripe that has enough intact
+    parity. Returns (bad data blocks, bad parity blocks, {data block: repaired bytes}, unrecoverable blocks)."""
+    import numpy as np
+    sources, origin, segment, block_size, digest_size, data_digests, parity_digests, parity_path = args
+    width, rows, parity_count = segment['width'], segment['rows'], segment['parity']
+    first_block, blocks = segment['first_block'], segment['blocks']
+    stream = DiscStream(sources, origin)
+
+    def read_block(block):
+        try:
+            return stream.read(block * block_size, block_size)
+        except OSError:
+            stream.close()
+            return None
+
+    def read_parity_block(index):
+        try:
+            with open(parity_path, 'rb') as f:
+                f.seek((segment['parity_block'] + index) * block_size)
+                data = f.read(block_size)
+        except OSError:
+            return None
+        return data if len(data) == block_size else None
+
+    def intact(data, digests, index):
+        return data is not None and block_digest(data) == digests[index * digest_size:(index + 1) * digest_size]
+
+    try:
+        bad_data = [b for b in range(blocks) if not intact(read_block(first_block + b), data_digests, b)]
+        bad_parity = [p for p in range(parity_count * width) if not intact(read_parity_block(p), parity_digests, p)]
+
+        repaired = {}
+        unrecoverable = []
+        if bad_data:
+            multiply = gf_multiplier()
+            coefficients = parity_coefficients(parity_count, rows)
+            bad_data_set = set(bad_data)
+            bad_parity_set = set(bad_parity)
+            for stripe in sorted({b % width for b in bad_data}):
+                missing = [row for row in range(rows) if row * width + stripe in bad_data_set]
+                usable = [r for r in range(parity_count) if r * width + stripe not in bad_parity_set][:len(missing)]
+                if len(usable) < len(missing):
+                    unrecoverable.extend(first_block + row * width + stripe for row in missing)
+                    continue
+                known = {row: np.frombuffer(read_block(first_block + row * width + stripe), dtype=np.uint8)
+                         for row in range(rows)
+                         if row * width + stripe < blocks and row * width + stripe not in bad_data_set}
+                syndromes = []
+                for r in usable:
+                    syndrome = np.frombuffer(read_parity_block(r * width + stripe), dtype=np.uint8).copy()
+                    for row, block in known.items():
+                        np.bitwise_xor(syndrome, multiply[coefficients[r][row]][block], out=syndrome)
+                    syndromes.append(syndrome)
+                inverse = gf_invert_matrix([[coefficients[r][row] for row in missing] for r in usable])
+                for a, row in enumerate(missing):
+                    block = np.zeros(block_size, dtype=np.uint8)
+                    for b, syndrome in enumerate(syndromes):
+                        np.bitwise_xor(block, multiply[inverse[a][b]][syndrome], out=block)
+                    local = row * width + stripe
+                    if intact(block.tobytes(), data_digests, local):
+                        repaired[first_block + local] = block.tobytes()
+                    else:
+                        unrecoverable.append(first_block + local)
+    finally:
+        stream.close()
+    return [first_block + b for b in bad_data], bad_parity, repaired, unrecoverable
+
+def repair_disc(disc_dir, output_dir=None):
+    """Check a disc against its recovery data and, given output_dir, write repaired copies of damaged files
+    there. Returns (damaged files, repaired files, unrecoverable files)."""
+    from tqdm import tqdm
+    parity_dir = os.path.join(disc_dir, PARITY_DIR)
+    with open(os.path.join(parity_dir, 'parity.json'), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    with open(os.path.join(parity_dir, 'hashes.bin'), 'rb') as f:
+        digests = f.read()
+    block_size, digest_size = index['block_size'], index['digest_size']
+    files = index['files']
+    sources = [(os.path.join(disc_dir, *path.split('/')), 0, size) for path, size in files]
+    starts = list(itertools.accumulate([0] + [size for _, size in files]))
+    data_digest_bytes = index['data_blocks'] * digest_size
+
+    tasks = []
+    for segment in index['segments']:
+        first, blocks = segment['first_block'], segment['blocks']
+        parity_first, parity_count = segment['parity_block'], segment['parity'] * segment['width']
+        tasks.append(segment_sources(sources, starts, segment, block_size) + (
+            segment, block_size, digest_size,
+            digests[first * digest_size:(first + blocks) * digest_size],
+            digests[data_digest_bytes + parity_first * digest_size:data_digest_bytes + (parity_first + parity_count) * digest_size],
+            os.path.join(parity_dir, 'parity.bin')))
+
+    bad_blocks = set()
+    repaired = {}
+    unrecoverable = set()
+    bad_parity = 0
+    with multiprocessing.Pool(processes=getCPUs()) as pool:
+        for bad, bad_parity_blocks, segment_repaired, segment_unrecoverable in tqdm(
+                pool.imap(check_parity_segment, tasks), total=len(tasks), desc="Checking disc", unit="segment"):
+            bad_blocks.update(bad)
+            bad_parity += len(bad_parity_blocks)
+            repaired.update(segment_repaired)
+            unrecoverable.update(segment_unrecoverable)
+    if bad_parity:
+        print(f"{bad_parity} recovery blocks are damaged themselves")
+
+    damaged_files, repaired_files, unrecoverable_files = [], [], []
+    stream = DiscStream(sources)
+
+    def file_damaged(start, size, block):
+        # Blocks are shared by neighbouring files, so a bad block only damages the files whose bytes differ
+        begin = max(start, block * block_size)
+        end = min(start + size, (block + 1) * block_size)
+        try:
+            on_disc = stream.read(begin, end - begin)
+        except OSError:
+            stream.close()
+            return True
+        offset = block * block_size
+        return on_disc != repaired[block][begin - offset:end - offset]
+
+    try:
+        for (path, size), start in zip(files, starts):
+            file_blocks = range(start // block_size, -(-(start + size) // block_size))
+            bad = [block for block in file_blocks if block in bad_blocks]
+            if size == 0 or not bad:
+                continue
+            if any(block in unrecoverable for block in bad):
+                damaged_files.append(path)
+                unrecoverable_files.append(path)
+                continue
+            if not any(file_damaged(start, size, block) for block in bad):
+                continue
+            damaged_files.append(path)
+            repaired_files.append(path)
+            if output_dir is None:
+                continue
+            output_path = os.path.join(output_dir, *path.split('/'))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'wb') as out:
+                for block in file_blocks:
+                    data = repaired.get(block)
+                    if data is None:
+                        data = stream.read(block * block_size, block_size)
+                    begin = max(start, block * block_size) - block * block_size
+                    end = min(start + size, (block + 1) * block_size) - block * block_size
+                    out.write(data[begin:end])
+    finally:
+        stream.close()
+    return damaged_files, repaired_files, unrecoverable_files
+
+def repair_main(argv):
+    parser = argparse.ArgumentParser(prog='process.py repair',
+                                     description="Check a disc against its recovery data and rebuild damaged files.")
+    parser.add_argument('disc', help="Mounted disc or Disc_N directory")
+    parser.add_argument('output', nargs='?', help="Where to write repaired copies of damaged files; without it the disc is only checked")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.disc, PARITY_DIR, 'parity.json')):
+        print(f"Error: no recovery data found in {args.disc}")
+        return 1
+    damaged, repaired, unrecoverable = repair_disc(args.disc, args.output)
+    if not damaged:
+        print("All files are intact.")
+        return 0
+    for path in damaged:
+        if path in unrecoverable:
+            state = "unrecoverable"
+        elif args.output:
+            state = "repaired"
+        else:
+            state = "repairable"
+        print(f"{state}: {path}")
+    print(f"{len(damaged)} damaged files, {len(repaired)} {'repaired' if args.output else 'repairable'}, {len(unrecoverable)} unrecoverable")
+    return 1 if unrecoverable else 0
+
+# Disc images. With --output iso the originals are never staged: each planned disc is streamed from the
+# source files straight into a UDF image, and the files are hashed as they are written. Only the
+# generated files (gallery, renditions, catalog) are staged in Disc_N/ while the image is built.
+DISC_IMAGE_RESERVE = 0.05  # share of each disc kept free for the gallery pages, catalog and filesystem overhead
+MANIFEST_NAME = 'hash_manifest.json'
+CATALOG_IMAGE_SLACK = 1024 * 1024  # room for the catalog to grow when its hashes are filled in
+
+def check_disc_size(name, size, max_size):
+    """Warn when a finished disc came out larger than the disc it was packed for; the packing reserves are
+    estimates, so this is where a disc that will not burn shows up."""
+    if size > max_size:
+        logging.warning(f"{name} holds {size / (1024 * 1024 * 1024):.2f} GB, more than the "
+                        f"{max_size / (1024 * 1024 * 1024):.2f} GB it was packed for ({size - max_size} bytes over), "
+                        "and will not fit on the disc")
+    return size <= max_size
+
+def check_disc_contents(conn, disc_index, disc_dir):
+    """Warn when the originals staged in disc_dir differ from the files the catalog lists for the disc, such as
+    files left behind by an earlier run. Returns True when they match."""
+    cataloged = {disc_path for disc_path, in conn.execute(
+        "SELECT disc_path FROM files WHERE disc = ? AND sha256 IS NOT NULL", (disc_index,))}
+    staged = set()
+    for root, dirs, files in os.walk(disc_dir):
+        dirs[:] = [d for d in dirs if d not in {GALLERY_ASSET_DIR, PARITY_DIR, 'thumbs', 'previews', PROXY_DIR}]
+        generated = {'hash_manifest.json'} | ({CATALOG_NAME, 'index.html', 'catalog.html'} if root == disc_dir else set())
+        staged.update(os.path.relpath(os.path.join(root, file), disc_dir).replace(os.sep, '/')
+                      for file in files if file not in generated)
+    unexpected, missing = sorted(staged - cataloged), sorted(cataloged - staged)
+    if unexpected:
+        logging.warning(f"Disc_{disc_index} holds {len(unexpected)} files the catalog does not list for it: {', '.join(unexpected[:10])}")
+    if missing:
+        logging.warning(f"Disc_{disc_index} is missing {len(missing)} files the catalog lists for it: {', '.join(missing[:10])}")
+    return not unexpected and not missing
+
+def staged_disc_size(disc_dir):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(disc_dir) for file in files)
+
+def import_pycdlib():
+    try:
+        import pycdlib
+    except ImportError:
+        raise RuntimeError("--output iso needs pycdlib (pip install pycdlib)")
+    return pycdlib
+
+class HashingSourceFile:
+    """File-like source for pycdlib that opens the file on first use and hashes it while it is copied
+    into the image. If the reads were not one sequential pass, hexdigest() returns None."""
+    mode = 'rb'
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.file = None
+        self.hasher = hashlib.sha256()
+        self.position = 0
+        self.hashed = 0
+        self.sequential = True
+        self.error = None
+
+    def _open(self):
+        if self.file is None and self.error is None:
+            try:
+                self.file = open(self.path, 'rb')
+            except OSError as e:
+                self.error = f"Could not read {self.path}: {e}"
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._open()
+        if self.file is not None:
+            self.file.seek(offset)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        self._open()
+        if size < 0:
+            size = self.size - self.position
+        wanted = max(0, min(size, self.size - self.position))
+        data = self.file.read(wanted) if self.file is not None else b''
+        if len(data) < wanted:
+            # Unreadable or shrunken sources still fill their planned extent so the rest of the image is intact
+            if self.error is None:
+                self.error = f"{self.path} changed while the image was written (expected {self.size} bytes)"
+            data += b'\0' * (wanted - len(data))
+        if self.position != self.hashed:
+            self.sequential = False
+        elif self.error is None:
+            self.hasher.update(data)
+            self.hashed += len(data)
+        self.position += len(data)
+        if self.position >= self.size:
+            self.close()
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def hexdigest(self):
+        if self.sequential and self.hashed == self.size:
+            return self.hasher.hexdigest()
+        return None
+
+def manifest_bytes(manifest):
+    return json.dumps(manifest, indent=2).encode('utf-8')
+
+def reserved_manifest_size(paths):
+    # Worst case: every file has its own hash, so every path gets its own entry
+    return len(manifest_bytes({f"{i:064x}": [path] for i, path in enumerate(paths)}))
+
+@contextmanager
+def disc_image_editor(image_path):
+    """Yield modify(fp, length, udf_path) that overwrites a file inside a finished image in place."""
+    pycdlib = import_pycdlib()
+    if hasattr(pycdlib, 'InPlaceEditor'):
+        with pycdlib.InPlaceEditor(image_path) as editor:
+            yield lambda fp, length, udf_path: editor.modify_file(fp, length, udf_path=udf_path)
+    else:
+        iso = pycdlib.PyCdlib()
+        iso.open(image_path, 'r+b')
+        try:
+            yield lambda fp, length, udf_path: iso.modify_file_in_place(fp, length, None, udf_path=udf_path)
+        finally:
+            iso.close()
+
+def disc_image_files(image_path):
+    """List (disc path, size) and matching (image path, offset, size) sources for the files in an image,
+    leaving out the recovery data."""
+    pycdlib = import_pycdlib()
+    iso = pycdlib.PyCdlib()
+    iso.open(image_path)
+    entries = []
+    try:
+        for root, _, names in iso.walk(udf_path='/'):
+            for name in names:
+                udf_path = posixpath.join(root, name)
+                disc_path = udf_path.lstrip('/')
+                if disc_path.startswith(PARITY_DIR + '/'):
+                    continue
+                record = iso.get_record(udf_path=udf_path)
+                size = record.get_data_length()
+                offset = record.inode.orig_extent_loc * iso.logical_block_size if record.inode is not None else 0
+                entries.append((disc_path, size, offset))
+    finally:
+        iso.close()
+    entries.sort()
+    return [(path, size) for path, size, _ in entries], [(image_path, offset, size) for _, size, offset in entries]
+
+def reserve_disc_parity(parity_dir, files, fraction):
+    # Placeholders sized for the largest the recovery data can be; the real files are never larger
+    os.makedirs(parity_dir, exist_ok=True)
+    data_blocks, segments, parity_blocks = parity_layout(sum(size for _, size in files), fraction)
+    with open(os.path.join(parity_dir, 'parity.json'), 'w', encoding='utf-8') as f:
+        f.write(parity_index_json(files, fraction, data_blocks, segments, parity_blocks))
+    for name, size in (('hashes.bin', (data_blocks + parity_blocks) * PARITY_DIGEST_SIZE),
+                       ('parity.bin', parity_blocks * PARITY_BLOCK_SIZE)):
+        with open(os.path.join(parity_dir, name), 'wb') as f:
+            f.truncate(size)
+
+def build_disc_image(disc_index, disc, inventory, overlay_dir, image_path, catalog, thumbnail_format, preview_size, disc_metadata, parity=0):
+    """Write one planned disc (rows of inventory) to image_path. Returns (number of files written, list of per-file errors)."""
+    from tqdm import tqdm
+    pycdlib = import_pycdlib()
+    media = [(os.path.join(source_dir_global, inventory.source_path(row)), inventory.disc_path(row), inventory.size[row])
+             for row in disc]
+
+    if proxy_queue:
+        print(f"Placed {write_disc_proxies(overlay_dir, disc, inventory)} video proxies for Disc_{disc_index}")
+    generate_html_gallery(overlay_dir, thumbnail_format, preview_size, disc_metadata,
+                          media_files=[(source_path, disc_path) for source_path, disc_path, _ in media])
+
+    # The catalog goes on the image before this disc's hashes are known, so its copy on the image is written
+    # with placeholders and padding, then replaced once the image has been written and hashed. The master
+    # catalog never holds the placeholders, so a file that fails to image keeps no hash there.
+    export_catalog_to_disc(catalog, overlay_dir, disc_index)
+    overlay_catalog = os.path.join(overlay_dir, CATALOG_NAME)
+    placeholder_catalog = sqlite3.connect(overlay_catalog)
+    with placeholder_catalog:
+        placeholder_catalog.execute("UPDATE files SET sha256 = ? WHERE disc = ?", ('0' * 64, disc_index))
+    placeholder_catalog.close()
+    with open(overlay_catalog, 'rb') as f:
+        catalog_bytes = f.read()
+    os.remove(overlay_catalog)
+
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=4, udf='2.60', vol_ident=f"DISC_{disc_index}")
+    directories = set()
+
+    def add_parent_directories(disc_path):
+        parts = disc_path.split('/')[:-1]
+        for depth in range(1, len(parts) + 1):
+            directory = '/'.join(parts[:depth])
+            if directory not in directories:
+                iso.add_directory(udf_path='/' + directory)
+                directories.add(directory)
+
+    # Each directory holding archived files gets a manifest covering everything beneath it, as on staged discs
+    manifest_dirs = {posixpath.dirname(disc_path) for _, disc_path, _ in media}
+    manifest_files = defaultdict(list)
+    sources = []
+    for source_path, disc_path, file_size in media:
+        add_parent_directories(disc_path)
+        source = HashingSourceFile(source_path, file_size)
+        iso.add_fp(source, file_size, udf_path='/' + disc_path)
+        sources.append((source, disc_path))
+        directory = posixpath.dirname(disc_path)
+        while True:
+            if directory in manifest_dirs:
+                manifest_files[directory].append(disc_path)
+            if not directory:
+                break
+            directory = posixpath.dirname(directory)
+
+    reserved_files = [(disc_path, file_size) for _, disc_path, file_size in media]
+    for manifest_dir, paths in manifest_files.items():
+        placeholder = b' ' * reserved_manifest_size([posixpath.relpath(path, manifest_dir or '.') for path in paths])
+        manifest_path = posixpath.join(manifest_dir, MANIFEST_NAME)
+        iso.add_fp(io.BytesIO(placeholder), len(placeholder), udf_path='/' + manifest_path)
+        reserved_files.append((manifest_path, len(placeholder)))
+    catalog_placeholder = catalog_bytes + b'\0' * CATALOG_IMAGE_SLACK
+    iso.add_fp(io.BytesIO(catalog_placeholder), len(catalog_placeholder), udf_path='/' + CATALOG_NAME)
+    reserved_files.append((CATALOG_NAME, len(catalog_placeholder)))
+
+    overlay_files = []
+    for root, _, files in os.walk(overlay_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            overlay_files.append((file_path, os.path.relpath(file_path, overlay_dir).replace(os.sep, '/')))
+    parity_dir = os.path.join(overlay_dir, PARITY_DIR)
+    if parity:
+        reserved_files.extend((disc_path, os.path.getsize(file_path)) for file_path, disc_path in overlay_files)
+        reserve_disc_parity(parity_dir, sorted(reserved_files), parity)
+        overlay_files.extend((os.path.join(parity_dir, name), f"{PARITY_DIR}/{name}")
+                             for name in ('parity.json', 'hashes.bin', 'parity.bin'))
+    for file_path, disc_path in overlay_files:
+        add_parent_directories(disc_path)
+        iso.add_file(file_path, udf_path='/' + disc_path)
+
+    run_report.record('image', files=len(media), size=sum(file_size for _, _, file_size in media))
+    with run_report.stage('image'), tqdm(desc=f"Writing Disc_{disc_index}.iso", unit='B', unit_scale=True) as pbar:
+        def progress(done, total, opaque=None):
+            pbar.total = total
+            pbar.update(done - pbar.n)
+        iso.write(image_path, progress_cb=progress)
+    iso.close()
+
+    disc_hashes = {}
+    errors = []
+    for source, disc_path in sources:
+        if source.error:
+            logging.error(source.error)
+            errors.append(source.error)
+            continue
+        disc_hashes[disc_path] = source.hexdigest() or get_file_hash(source.path)
+        logging.debug(f"Imaged {source.path}", extra={'processed': f"Successfully imaged: {source.path} -> {image_path}:/{disc_path}"})
+    record_disc_hashes(catalog, disc_index, disc_hashes)
+
+    export_catalog_to_disc(catalog, overlay_dir, disc_index)
+    with open(overlay_catalog, 'rb') as f:
+        catalog_bytes = f.read()
+    if len(catalog_bytes) > len(catalog_placeholder):
+        raise RuntimeError(f"Catalog outgrew the space reserved for it on Disc_{disc_index}.iso")
+
+    print("Writing hash manifests and catalog into the image...")
+    with disc_image_editor(image_path) as modify:
+        for manifest_dir, paths in manifest_files.items():
+            manifest = defaultdict(list)
+            for path in paths:
+                if path in disc_hashes:
+                    manifest[disc_hashes[path]].append(posixpath.relpath(path, manifest_dir or '.'))
+            data = manifest_bytes(manifest)
+            modify(io.BytesIO(data), len(data), posixpath.join('/', manifest_dir, MANIFEST_NAME))
+        modify(io.BytesIO(catalog_bytes), len(catalog_bytes), '/' + CATALOG_NAME)
+
+    if parity:
+        # Encoded from the finished image, so the recovery data matches exactly what gets burned
+        files, sources = disc_image_files(image_path)
+        write_disc_parity(parity_dir, files, sources, parity)
+        with disc_image_editor(image_path) as modify:
+            for name in ('parity.json', 'hashes.bin', 'parity.bin'):
+                with open(os.path.join(parity_dir, name), 'rb') as f:
+                    modify(f, os.path.getsize(os.path.join(parity_dir, name)), f"/{PARITY_DIR}/{name}")
+
+    return len(disc_hashes), errors
 
-        # Create the full path for the destination, including album folder
-        dest_dir = os.path.dirname(dest_path)
-        if not os.path.exists(dest_dir):
-            try:
-                os.makedirs(dest_dir, exist_ok=True)
-                logging.debug(f"Created destination directory: {dest_dir}")
-            except Exception as e:
-                logging.error(f"Failed to create destination directory {dest_dir}: {str(e)}")
-                return None, 0, None, f"Failed to create destination directory {dest_dir}: {str(e)}"
-        elif not os.access(dest_dir, os.W_OK):
-            logging.error(f"No write permission for destination directory: {dest_dir}")
-            return None, 0, None, f"No write permission for destination directory: {dest_dir}"
-
-        # Check available space (for POSIX systems)
-        if os.name == 'posix':
-            stats = os.statvfs(dest_dir)
-            available_space = stats.f_frsize * stats.f_bavail
-            if file_size > available_space:
-                logging.error(f"Not enough disk space to copy {source_path}. Required: {file_size}, Available: {available_space}")
-                return None, 0, None, f"Not enough disk space to copy {source_path}. Required: {file_size}, Available: {available_space}"
-
-        # Perform the copy or move operation
-        try:
-            if move_files_global:
-                logging.debug(f"Moving file: {source_path} -> {dest_path}")
-                shutil.move(source_path, dest_path)
-            else:
-                logging.debug(f"Copying file: {source_path} -> {dest_path}")
-                shutil.copy2(source_path, dest_path)
-        except Exception as e:
-            logging.error(f"{'Move' if move_files_global else 'Copy'} operation failed for {source_path}: {str(e)}")
-            return None, 0, None, f"{'Move' if move_files_global else 'Copy'} operation failed for {source_path}: {str(e)}"
-
-        # Verify the file was actually copied/moved
-        if not os.path.exists(dest_path):
-            logging.error(f"File was not {'moved' if move_files_global else 'copied'} to destination: {dest_path}")
-            return None, 0, None, f"File was not {'moved' if move_files_global else 'copied'} to destination: {dest_path}"
-
-        # Log successful operation
-        with log_lock:
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(f"Successfully {'moved' if move_files_global else 'copied'}: {source_path} -> {dest_path}\n")
-        
-        logging.debug(f"Successfully processed file: {source_path} -> {dest_path}")
-        return source_path, file_size, dest_path, None
-    except Exception as e:
-        error_msg = f"Unexpected error processing {source_path}: {str(e)}\n{traceback.format_exc()}"
-        logging.error(error_msg)
-        return None, 0, None, error_msg
-        
 def calculate_similarity(album1, album2):
     date1 = album1[2]
     date2 = album2[2]
     return abs((date1 - date2).days)
 
-def optimize_disc_packing(albums, max_size, min_fill_ratio=0.9):
+def optimize_disc_packing(inventory, max_size, min_fill_ratio=0.9, reserve=None):
+    """Plan the discs. Each disc takes the largest whole segment that still fits, until none does; a disc
+    that is then less than min_fill_ratio full is topped up with files from the largest segment, which
+    is the only time an album is split. reserve adds bytes per row, as from proxy_reserve.
+    Returns one array of inventory rows per disc."""
+    import numpy as np
+    from tqdm import tqdm
     optimized_discs = []
-    current_disc = []
+    current_disc = array('q')
     current_size = 0
-    
-    # Convert albums to a list of (total_size, album_name, segment_name, structure) tuples
-    with Pool(processes=getCPUs()) as pool:
-        album_structures = list(tqdm(pool.imap(get_album_structure, albums), total=len(albums), desc="Analyzing albums"))
-    
-    album_heap = [(-total_size, album_name, segment_name, structure) for album_name, segment_name, structure, total_size in album_structures]
-    heapq.heapify(album_heap)
-    
-    while album_heap:
-        _, album_name, segment_name, structure = heapq.heappop(album_heap)
-        
-        for year_month, files in sorted(structure.items(), key=lambda x: sum(f[1] for f in x[1]), reverse=True):
-            files.sort(key=lambda x: x[1], reverse=True)
-            
-            while files:
-                file_path, file_size = files.pop(0)
-                
-                if file_size > max_size:
-                    print(f"Warning: File {file_path} in album {album_name} exceeds max disc size. Skipping.")
-                    continue
-                
-                if current_size + file_size <= max_size:
-                    current_disc.append((album_name, segment_name, file_path, file_size))
-                    current_size += file_size
-                else:
-                    if current_size / max_size >= min_fill_ratio or not current_disc:
-                        optimized_discs.append(current_disc)
-                        current_disc = [(album_name, segment_name, file_path, file_size)]
-                        current_size = file_size
-                    else:
-                        # Try to find a smaller file that fits
-                        found_smaller = False
-                        for i, (small_file_path, small_file_size) in enumerate(files):
-                            if current_size + small_file_size <= max_size:
-                                current_disc.append((album_name, segment_name, small_file_path, small_file_size))
-                                current_size += small_file_size
-                                files.pop(i)
-                                found_smaller = True
-                                break
-                        
-                        if not found_smaller:
-                            optimized_discs.append(current_disc)
-                            current_disc = [(album_name, segment_name, file_path, file_size)]
-                            current_size = file_size
-            
-            # Update the album heap with remaining files
-            remaining_size = sum(f[1] for f in files)
-            if remaining_size > 0:
-                heapq.heappush(album_heap, (-remaining_size, album_name, segment_name, {year_month: files}))
-        
-        # Try to fill remaining space with files from other albums
-        while album_heap and current_size < max_size * min_fill_ratio:
-            next_album = album_heap[0]
-            next_album_name = next_album[1]
-            next_segment_name = next_album[2]
-            next_album_structure = next_album[3]
-            next_year_month = next(iter(next_album_structure))
-            next_files = next_album_structure[next_year_month]
-            
-            filled = False
-            for i, (file_path, file_size) in enumerate(next_files):
-                if current_size + file_size <= max_size:
-                    current_disc.append((next_album_name, next_segment_name, file_path, file_size))
-                    current_size += file_size
-                    next_files.pop(i)
-                    filled = True
+    sizes = inventory.column('size')
+    if reserve is not None:
+        # A file that fits a disc on its own is still archived when its reserve would not fit too; it gets a
+        # disc to itself, and the check on the finished disc reports it if it does overflow
+        sizes = np.where(sizes > max_size, sizes, np.minimum(sizes + reserve, max_size))
+
+    # Segments that were split, or hold files too large for any disc, are kept as (sizes, rows) lists
+    # sorted by size; the others are added as their range of rows
+    pending = {}
+    def segment_files(segment_id):
+        if segment_id not in pending:
+            rows = inventory.segment_rows(segment_id)
+            order = np.argsort(sizes[rows.start:rows.stop], kind='stable') + rows.start
+            pending[segment_id] = (sizes[order].tolist(), order.tolist())
+        return pending[segment_id]
+
+    def largest_fitting(files, room):
+        # Index of the largest file no bigger than room, or -1
+        return bisect.bisect_right(files[0], room) - 1
+
+    for row in np.flatnonzero(sizes > max_size).tolist():
+        logging.warning(f"File {inventory.source_path(row)} exceeds max disc size. Skipping.")
+        files = segment_files(inventory.segment[row])
+        files[0].pop()
+        files[1].pop()
+
+    # Segments by remaining size, smallest first, for finding the largest one that fits with bisect
+    candidates = sorted((sum(pending[segment_id][0]) if segment_id in pending else int(sizes[rows.start:rows.stop].sum()), segment_id)
+                        for segment_id, rows in enumerate(map(inventory.segment_rows, range(len(inventory.segments)))))
+    candidates = [candidate for candidate in candidates if candidate[1] not in pending or pending[candidate[1]][0]]
+    candidate_sizes = [size for size, _ in candidates]
+    candidate_ids = [segment_id for _, segment_id in candidates]
+
+    def close_disc():
+        nonlocal current_disc, current_size
+        optimized_discs.append(current_disc)
+        current_disc, current_size = array('q'), 0
+
+    with tqdm(total=len(inventory), desc="Packing files", unit="file") as progress:
+        while candidate_sizes:
+            i = bisect.bisect_right(candidate_sizes, max_size - current_size) - 1
+            if i >= 0:
+                segment_size = candidate_sizes.pop(i)
+                segment_id = candidate_ids.pop(i)
+                rows = pending.pop(segment_id)[1] if segment_id in pending else inventory.segment_rows(segment_id)
+                current_disc.extend(rows)
+                current_size += segment_size
+                progress.update(len(rows))
+                continue
+            if current_disc and current_size >= max_size * min_fill_ratio:
+                close_disc()
+                continue
+
+            # Nothing fits whole and the disc still has room: fill it with the largest segment's files
+            segment_size = candidate_sizes.pop()
+            segment_id = candidate_ids.pop()
+            files = segment_files(segment_id)
+            taken = 0
+            while files[0]:
+                j = largest_fitting(files, max_size - current_size - taken)
+                if j < 0:
                     break
-            
-            if not filled:
-                break
-            
-            if not next_files:
-                heapq.heappop(album_heap)
+                taken += files[0].pop(j)
+                current_disc.append(files[1].pop(j))
+                progress.update(1)
+            current_size += taken
+            if files[0]:
+                remaining = segment_size - taken
+                k = bisect.bisect_left(candidate_sizes, remaining)
+                candidate_sizes.insert(k, remaining)
+                candidate_ids.insert(k, segment_id)
             else:
-                heapq.heapreplace(album_heap, (-sum(f[1] for f in next_files), next_album_name, next_segment_name, {next_year_month: next_files}))
-    
+                del pending[segment_id]
+            if not taken:
+                close_disc()
+
     if current_disc:
         optimized_discs.append(current_disc)
-    
-    return optimized_discs
 
+    return optimized_discs
 
     
 def cleanup():
@@ -952,7 +3544,9 @@ def cleanup():
         finally:
             et = None
     try:
-        exiftool.ExifToolHelper.terminate()
+        # Only if a stage has loaded it; importing it here just to clean up would defeat the lazy import
+        if 'exiftool' in sys.modules:
+            sys.modules['exiftool'].ExifToolHelper.terminate()
     except:
         pass
     time.sleep(0.1)
@@ -961,70 +3555,143 @@ def cleanup():
 def getCPUs(n=1):
     return max(1,multiprocessing.cpu_count()-n) # we keep one core free for the system/user, to prevent thrashing
     
-def organize_media(source_dir, dest_dir, move_files=False, max_size=23.2 * 1024 * 1024 * 1024):
-    global source_dir_global, dest_dir_global, move_files_global, file_hashes
+def organize_media(source_dir, dest_dir, move_files=False, max_size=23.2 * 1024 * 1024 * 1024,
+                   thumbnail_format='WEBP', preview_size=PREVIEW_SIZE, incremental=False, output='directory', parity=0.05,
+                   report_path=None, prometheus_path=None, profile=None, proxies=False, proxy_jobs=2, proxy_timeout=PROXY_TIMEOUT):
+    global source_dir_global, dest_dir_global, move_files_global, file_hashes, run_report, profile_mode, profile_dir, inventory, proxy_queue
+    from tqdm import tqdm
     source_dir_global = os.path.abspath(source_dir)
     dest_dir_global = os.path.abspath(dest_dir)
     move_files_global = move_files
+    thumbnail_format = resolve_thumbnail_format(thumbnail_format)
 
     manager = Manager()
     processed_counter = Value('i', 0)
     current_disc = Value('i', 1)
     file_hashes = manager.dict()
-    log_lock = Lock()
 
-    log_file = os.path.join(dest_dir_global, 'processed_files.log')
+    os.makedirs(dest_dir_global, exist_ok=True)
+    stop_event_log = start_event_log(dest_dir_global)
+    run_report = RunReport()
+    # What this process spent importing its modules; each worker pool adds its own startup under startup.<stage>
+    run_report.record('startup', IMPORT_SECONDS, files=0)
+    if profile:
+        profile_mode = profile
+        profile_dir = os.path.join(dest_dir_global, 'profile')
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        os.makedirs(os.path.join(profile_dir, 'raw'))
+    proxy_queue = ProxyQueue(os.path.join(dest_dir_global, PROXY_CACHE_DIR), proxy_jobs, proxy_timeout) if proxies else None
     
     try:
         print(f"Scanning directories... Using {getCPUs(0)} CPUs")
-        segmented_albums = get_segmented_albums(source_dir_global)
-        albums = []
-        
-        with ProcessPoolExecutor(max_workers=getCPUs(0)) as executor:
-            future_to_album = {executor.submit(get_album_info, album_data): album_data for album_data in segmented_albums}
+        with run_report.stage('scan'):
+            catalog = open_catalog(os.path.join(dest_dir_global, CATALOG_NAME), source_dir_global)
+            if incremental:
+                discarded = discard_incomplete_discs(catalog)
+                if discarded:
+                    restored = sum(clear_discarded_disc(dest_dir_global, source_dir_global, disc_index, files)
+                                   for disc_index, files in discarded.items())
+                    print(f"Discarded {len(discarded)} discs that the previous run did not finish; their files are archived again")
+                    if restored:
+                        print(f"Moved {restored} files from the discarded discs back to {source_dir_global}")
+                # Only files that are new or changed since they were archived go on to dating and packing
+                inventory, skipped = scan_inventory(source_dir_global, archived=load_archived_files(catalog))
+                first_disc = next_disc_index(catalog)
+                print(f"Incremental run: {skipped} files are already archived, new discs start at Disc_{first_disc}")
+            else:
+                inventory, _ = scan_inventory(source_dir_global)
+                reset_catalog(catalog)
+                first_disc = 1
+            run_report.record('scan', files=len(inventory))
+
+        with run_report.stage('dates'), ProcessPoolExecutor(max_workers=getCPUs(0), **pool_initializer(
+                'dates', init_inventory, (inventory,))) as executor:
+            futures = [executor.submit(timed_task, get_segment_metadata, segment_id) for segment_id in range(len(inventory.segments))]
             
-            for future in tqdm(as_completed(future_to_album), total=len(segmented_albums), desc="Processing album segments"):
-                album = future.result()
-                if album is not None:
-                    albums.append(album)
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing album segments"):
+                (segment_id, *metadata, file_seconds), _, cpu_seconds = future.result()
+                inventory.set_metadata(segment_id, *metadata)
+                rows = inventory.segment_rows(segment_id)
+                run_report.record('dates', cpu_seconds=cpu_seconds, files=len(rows), size=inventory.total_size(rows))
+                for seconds in file_seconds:
+                    run_report.record('dates', seconds, files=0)
 
         print("Packing discs...")
-        optimized_discs = optimize_disc_packing(albums, max_size)
+        if output == 'iso':
+            import_pycdlib()
+        capacity = max_size * (1 - DISC_IMAGE_RESERVE - parity_overhead(parity))
+        # Every file needs room for its renditions on the same disc, and videos for their proxies
+        reserve = rendition_reserve(inventory, thumbnail_format, preview_size)
+        if proxies:
+            reserve += proxy_reserve(inventory)
+        with run_report.stage('segments'):
+            split, reserve = segment_inventory(inventory, capacity * SEGMENT_DISC_SHARE, reserve=reserve)
+            run_report.record('segments', files=len(inventory))
+        print(f"{len(inventory.segments)} segments, {split} albums split by size and date")
+        with run_report.stage('packing'):
+            optimized_discs = optimize_disc_packing(inventory, capacity, reserve=reserve)
+            run_report.record('packing', files=sum(len(disc) for disc in optimized_discs))
+
+        for disc_index, disc in enumerate(optimized_discs, start=first_disc):
+            record_disc_plan(catalog, disc_index, disc, inventory)
 
-        for disc_index, disc in enumerate(optimized_discs, start=1):
+        for disc_index, disc in enumerate(optimized_discs, start=first_disc):
             current_disc_dir = os.path.join(dest_dir_global, f"Disc_{disc_index}")
             os.makedirs(current_disc_dir, exist_ok=True)
             
-            disc_size = sum(file_size for _, _, _, file_size in disc)
+            disc_size = inventory.total_size(disc)
             print(f"Packing Disc_{disc_index}: {disc_size / (1024*1024*1024):.2f} GB / {max_size / (1024*1024*1024):.2f} GB")
-            
-            with ProcessPoolExecutor(max_workers=getCPUs(),
-                                     initializer=init_worker,
-                                     initargs=(source_dir_global, dest_dir_global, move_files, file_hashes, log_lock)) as executor:
-                results = list(tqdm(
-                    executor.map(process_file, [(file_info, current_disc_dir, log_file) for file_info in disc]),
-                    total=len(disc),
+
+            # Dates and details from the metadata pass, keyed by their path on the disc, for the gallery
+            disc_metadata = {inventory.disc_path(row): inventory.media_info(row) for row in disc}
+
+            if output == 'iso':
+                image_path = os.path.join(dest_dir_global, f"Disc_{disc_index}.iso")
+                check_free_space(dest_dir_global, disc_size, os.path.basename(image_path))
+                imaged, errors = build_disc_image(disc_index, disc, inventory, current_disc_dir, image_path, catalog,
+                                                  thumbnail_format, preview_size, disc_metadata, parity)
+                shutil.rmtree(current_disc_dir)
+                check_disc_size(os.path.basename(image_path), os.path.getsize(image_path), max_size)
+                mark_disc_complete(catalog, disc_index)
+                with processed_counter.get_lock():
+                    processed_counter.value += imaged
+                print(f"Successfully imaged {imaged} out of {len(disc)} files into {image_path}")
+                if errors:
+                    print(f"Encountered {len(errors)} errors while imaging Disc_{disc_index}")
+                    error_log_path = os.path.join(dest_dir_global, f"error_log_disc_{disc_index}.txt")
+                    with open(error_log_path, 'w', encoding='utf-8') as error_log:
+                        for error in errors:
+                            error_log.write(f"{error}\n")
+                    print(f"Detailed error log written to: {error_log_path}")
+                with current_disc.get_lock():
+                    current_disc.value += 1
+                continue
+
+            with run_report.stage('copy'):
+                rows, errors = preflight_disc(current_disc_dir, disc, inventory, move_files)
+            with run_report.stage('copy'), ProcessPoolExecutor(max_workers=getCPUs(), **pool_initializer(
+                    'copy', init_worker, (source_dir_global, dest_dir_global, move_files, file_hashes, inventory))) as executor:
+                results = []
+                for result, seconds, cpu_seconds in tqdm(
+                    executor.map(partial(timed_task, process_file), [(row, current_disc_dir) for row in rows]),
+                    total=len(rows),
                     desc=f"Processing Disc_{disc_index}",
                     unit="file"
-                ))
+                ):
+                    run_report.record('copy', seconds, cpu_seconds, size=result[1])
+                    results.append(result)
             
             processed_subdirs = set()
             successful_copies = 0
-            errors = []
 
-            for result in results:
-                source_path, _, dest_path, error_msg = result
+            for source_path, _, dest_path, error_msg in results:
                 if error_msg:
                     errors.append(error_msg)
-                    print(f"Error processing a file in Disc_{disc_index}: {error_msg}")
-                elif source_path and dest_path:
-                    if os.path.exists(dest_path):
-                        with processed_counter.get_lock():
-                            processed_counter.value += 1
-                        processed_subdirs.add(os.path.dirname(dest_path))
-                        successful_copies += 1
-                    else:
-                        print(f"Warning: File not found at destination after processing: {dest_path}")
+                else:
+                    processed_subdirs.add(os.path.dirname(dest_path))
+                    successful_copies += 1
+            with processed_counter.get_lock():
+                processed_counter.value += successful_copies
             
             print(f"Successfully processed {successful_copies} out of {len(disc)} files for Disc_{disc_index}")
             if errors:
@@ -1038,43 +3705,134 @@ def organize_media(source_dir, dest_dir, move_files=False, max_size=23.2 * 1024
             print(f"Successfully processed {successful_copies} out of {len(disc)} files for Disc_{disc_index}")
             
             print("Creating hash manifests...")
-            for subdir in processed_subdirs:
-                create_manifest_file(subdir)
+            disc_hashes = {}
+            with run_report.stage('manifest'):
+                for subdir in processed_subdirs:
+                    manifest = create_manifest_file(subdir)
+                    subdir_path = os.path.relpath(subdir, current_disc_dir)
+                    for file_hash, paths in manifest.items():
+                        for path in paths:
+                            disc_hashes[os.path.join(subdir_path, path).replace(os.sep, '/')] = file_hash
+            record_disc_hashes(catalog, disc_index, disc_hashes)
+            check_disc_contents(catalog, disc_index, current_disc_dir)
+
+            if proxy_queue:
+                print(f"Placed {write_disc_proxies(current_disc_dir, disc, inventory)} video proxies for Disc_{disc_index}")
+            generate_html_gallery(current_disc_dir, thumbnail_format, preview_size, disc_metadata)
+
+            # Each disc is finished before the next one starts, so an interrupted run keeps the discs it wrote
+            print(f"Writing master catalog to Disc_{disc_index}...")
+            with run_report.stage('catalog'):
+                export_catalog_to_disc(catalog, current_disc_dir, disc_index)
+            if parity:
+                print(f"Writing recovery data for Disc_{disc_index}...")
+                write_directory_parity(current_disc_dir, parity)
+            check_disc_size(f"Disc_{disc_index}", staged_disc_size(current_disc_dir), max_size)
+            mark_disc_complete(catalog, disc_index)
 
-            generate_html_gallery(current_disc_dir)
-            
             with current_disc.get_lock():
                 current_disc.value += 1
 
+        catalog.commit()
+        catalog.close()
+
     except Exception as E:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         line_number = exc_tb.tb_lineno
         print(f"Error on line {line_number}: {E}")
     finally:
         cleanup()
+        # The writer holds the workers' startup times, which belong in the report
+        stop_event_log()
+        report_path = report_path or os.path.join(dest_dir_global, 'run_report.json')
+        run_report.write(report_path, prometheus_path, source=source_dir_global, destination=dest_dir_global,
+                         output=output, discs=current_disc.value - 1, files=processed_counter.value)
+        print(f"Run report written to {report_path}")
+        if profile_mode:
+            merge_profiles(profile_dir)
+            print(f"Profiles for each stage written to {profile_dir}")
 
     print(f"\nOrganized media files into {current_disc.value - 1} discs and generated HTML galleries.")
-    print(f"Files were {'moved' if move_files else 'copied'} to the destination.")
+    if output == 'iso':
+        print("Each disc was written as a Disc_N.iso image in the destination.")
+    else:
+        print(f"Files were {'moved' if move_files else 'copied'} to the destination.")
     print(f"Total files processed: {processed_counter.value}")
     print("Hash manifests created for each subdirectory.")
 
+COMMANDS = {
+    'lookup': lookup_main,
+    'repair': repair_main,
+}
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Organize media files into disc-sized folders with HTML galleries.")
+    parser.add_argument('source_directory', help="Directory containing your media files")
+    parser.add_argument('destination_directory', help="Where the Disc_N folders and galleries are created")
+    parser.add_argument('--move', action='store_true', help="Move files instead of copying them")
+    parser.add_argument('--thumbnail-format', default='webp', choices=['webp', 'avif', 'jpeg'],
+                        help="Codec for gallery thumbnails and previews (default: webp)")
+    parser.add_argument('--preview-size', type=int, default=PREVIEW_SIZE[0],
+                        help="Longest edge in pixels of the previews shown in the gallery modal (default: %(default)s)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only archive files that are new or changed since the run recorded in the destination's catalog")
+    parser.add_argument('--output', default='directory', choices=['directory', 'iso'],
+                        help="Stage each disc as a Disc_N folder, or stream it straight into a Disc_N.iso UDF image "
+                             "without copying the originals first (needs pycdlib) (default: directory)")
+    parser.add_argument('--parity', type=float, default=0.05,
+                        help="Fraction of each disc reserved for Reed-Solomon recovery data that the repair command "
+                             f"can rebuild damaged files from, up to {PARITY_MAX_FRACTION}; 0 turns it off (default: %(default)s)")
+    parser.add_argument('--report', help="Where to write the JSON run report with per-stage timings "
+                                         "(default: run_report.json in the destination)")
+    parser.add_argument('--profile', nargs='?', const='cprofile', choices=sorted(PROFILERS),
+                        help="Profile every stage, including the pool workers, into a profile folder in the destination: "
+                             "'cprofile' (the default) for exact call statistics, 'sample' for low-overhead stack samples")
+    parser.add_argument('--prometheus', help="Also write the stage timings as a Prometheus textfile, "
+                                             "e.g. into the node exporter's textfile collector directory")
+    parser.add_argument('--proxies', action='store_true',
+                        help=f"Transcode every video into a {PROXY_HEIGHT}p H.264 MP4 proxy that the gallery plays instead "
+                             "of the original, reserving room for it on the disc (needs ffmpeg with libx264)")
+    parser.add_argument('--proxy-jobs', type=int, default=2,
+                        help="Proxy transcodes to run at the same time (default: %(default)s)")
+    parser.add_argument('--proxy-timeout', type=int, default=PROXY_TIMEOUT,
+                        help="Seconds a single proxy transcode may take before it is abandoned (default: %(default)s)")
+    return parser
+
 if __name__ == "__main__":
-    if len(sys.argv) < 3 or len(sys.argv) > 4:
-        print("Usage: python script.py <source_directory> <destination_directory> [--move]")
-        sys.exit(1)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    args = build_arg_parser().parse_args()
 
-    source_directory = sys.argv[1]
-    destination_directory = sys.argv[2]
-    move_files = "--move" in sys.argv
+    source_directory = args.source_directory
+    destination_directory = args.destination_directory
+    move_files = args.move
 
     if not os.path.exists(source_directory):
         print(f"Error: Source directory '{source_directory}' does not exist.")
         sys.exit(1)
+    if not 0 <= args.parity <= PARITY_MAX_FRACTION:
+        print(f"Error: --parity must be between 0 and {PARITY_MAX_FRACTION}.")
+        sys.exit(1)
+    if move_files and args.output == 'iso':
+        print("Error: --move cannot be combined with --output iso; the originals are only read when imaging.")
+        sys.exit(1)
         
     os.makedirs(destination_directory, exist_ok=True)
 
     try:
-        organize_media(source_directory, destination_directory, move_files)
+        organize_media(source_directory, destination_directory, move_files,
+                       thumbnail_format=args.thumbnail_format,
+                       preview_size=(args.preview_size, args.preview_size),
+                       incremental=args.incremental,
+                       output=args.output,
+                       parity=args.parity,
+                       report_path=args.report,
+                       prometheus_path=args.prometheus,
+                       profile=args.profile,
+                       proxies=args.proxies,
+                       proxy_jobs=max(1, args.proxy_jobs),
+                       proxy_timeout=args.proxy_timeout)
     except KeyboardInterrupt:
         print("\nScript interrupted by user. Cleaning up...")
     except Exception as E: